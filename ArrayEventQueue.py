@@ -0,0 +1,242 @@
+"""
+Array Event Queue
+--------------------
+Summary: An event queue which keeps its bookkeeping in NumPy arrays.
+
+The queue never compares events, and never touches an event between
+adding it and returning it.  Timestamps, sequence numbers (which break
+ties between equal timestamps in the order events were added) and the
+index of each event in a payload array are stored in parallel arrays,
+sorted by (time, sequence).  getNextEvents finds the due events with one
+searchsorted call and returns them with a single slice, so ticks in
+which tens of thousands of events are due at once stay cheap.
+
+New events are first appended to plain lists.  On the next call that
+needs the queue to be in order they are sorted into a small sorted run,
+and the run is only merged into the main arrays once it grows large, so
+adding a few events per tick does not copy the whole queue every tick.
+"""
+
+import Timing
+from Event import AbstractQueue
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError("Unable to load numpy Python module, which ArrayEventQueue requires.")
+
+def _mergeRuns(first, second):
+    """
+    Merges two sorted runs, each a tuple of (times, sequences,
+    payloadIndices) arrays.  Every sequence number in 'second' must be
+    larger than those in 'first', so events with equal times from
+    'second' go after those from 'first'.
+    """
+    positions = numpy.searchsorted(first[0], second[0], side='right')
+    return tuple(numpy.insert(a, positions, b) for a, b in zip(first, second))
+
+def _emptyRun():
+
+    return (numpy.empty(0, numpy.float64), numpy.empty(0, numpy.int64),
+            numpy.empty(0, numpy.int64))
+
+class ArrayEventQueue(AbstractQueue):
+    """
+    A struct-of-arrays event queue.  Events which are already due when
+    they are added are executed on the next call to getNextEvents.
+    """
+
+    # the sorted run is merged into the main arrays once it holds more
+    # than this many events, or an eighth of the main arrays
+    minimumMergeSize = 4096
+
+    def __init__(self, startTime = None, capacity = 1024):
+        """
+        Sets up the empty arrays.  'capacity' is the initial number of
+        payload slots; the payload array doubles in size when it is full.
+        """
+
+        self._sequence = 0
+
+        # main sorted arrays; entries before _head have already been
+        # returned
+        self._main = _emptyRun()
+        self._head = 0
+        # small sorted run of recently added events
+        self._run = _emptyRun()
+        # events added since the last call which needed the queue sorted
+        self._stagedTimes = []
+        self._stagedPayloadIndices = []
+
+        self._payloads = numpy.empty(capacity, dtype=object)
+        self._payloadCount = 0
+        self._freePayloadIndices = []
+
+    def _storePayload(self, event):
+        """
+        Stores 'event' in a free payload slot and returns its index.
+        """
+        if self._freePayloadIndices:
+            index = self._freePayloadIndices.pop()
+        else:
+            index = self._payloadCount
+            if index == len(self._payloads):
+                payloads = numpy.empty(2*len(self._payloads), dtype=object)
+                payloads[:index] = self._payloads
+                self._payloads = payloads
+            self._payloadCount += 1
+
+        self._payloads[index] = event
+        return index
+
+    def addEvent(self,event):
+        """
+        Adds 'event' chronologically to the queue
+        """
+        self._stagedTimes.append(event.getTime())
+        self._stagedPayloadIndices.append(self._storePayload(event))
+        return True
+
+    def addEvents(self,events):
+        """
+        Adds every event in the iterable 'events' to the queue.  Returns
+        a list with the result of addEvent for each event.
+        """
+        storePayload = self._storePayload
+        appendTime = self._stagedTimes.append
+        appendPayloadIndex = self._stagedPayloadIndices.append
+        count = 0
+        for event in events:
+            appendTime(event.getTime())
+            appendPayloadIndex(storePayload(event))
+            count += 1
+        return [True]*count
+
+    def _sort(self):
+        """
+        Sorts the staged events into the run, and merges the run into the
+        main arrays once it has grown large enough.
+        """
+        if self._stagedTimes:
+            count = len(self._stagedTimes)
+            times = numpy.array(self._stagedTimes, numpy.float64)
+            sequences = numpy.arange(self._sequence, self._sequence + count,
+                                     dtype=numpy.int64)
+            payloadIndices = numpy.array(self._stagedPayloadIndices, numpy.int64)
+            self._sequence += count
+            self._stagedTimes = []
+            self._stagedPayloadIndices = []
+
+            # a stable sort keeps equal times in sequence order
+            order = numpy.argsort(times, kind='mergesort')
+            staged = (times[order], sequences[order], payloadIndices[order])
+            self._run = _mergeRuns(self._run, staged)
+
+        mainCount = len(self._main[0]) - self._head
+        if len(self._run[0]) > max(self.minimumMergeSize, mainCount // 8):
+            main = tuple(a[self._head:] for a in self._main)
+            self._main = _mergeRuns(main, self._run)
+            self._head = 0
+            self._run = _emptyRun()
+
+    def _takePayloads(self, payloadIndices):
+        """
+        Returns the events stored at 'payloadIndices' and frees their slots.
+        """
+        events = self._payloads[payloadIndices].tolist()
+        self._payloads[payloadIndices] = None
+        self._freePayloadIndices.extend(payloadIndices.tolist())
+        return events
+
+    def getNextEvents(self, currentTime=None):
+        """
+        Returns the events which have yet to be executed and occur before
+        currentTime.
+        """
+        if currentTime is None: currentTime = Timing.mostAccurateTime()
+
+        self._sort()
+        main, head, run = self._main, self._head, self._run
+
+        mainDue = int(numpy.searchsorted(main[0][head:], currentTime, side='right'))
+        runDue = int(numpy.searchsorted(run[0], currentTime, side='right'))
+
+        if runDue:
+            times = numpy.concatenate((main[0][head:head+mainDue], run[0][:runDue]))
+            sequences = numpy.concatenate((main[1][head:head+mainDue], run[1][:runDue]))
+            payloadIndices = numpy.concatenate((main[2][head:head+mainDue], run[2][:runDue]))
+            payloadIndices = payloadIndices[numpy.lexsort((sequences, times))]
+            self._run = tuple(a[runDue:] for a in run)
+        else:
+            payloadIndices = main[2][head:head+mainDue]
+
+        self._head = head = head + mainDue
+        if head > len(main[0]) // 2:
+            # let go of the memory used by events which have been returned
+            self._main = tuple(a[head:].copy() for a in main)
+            self._head = 0
+
+        return self._takePayloads(payloadIndices)
+
+    def _getNextPosition(self):
+        """
+        Returns (inMain, position) for the earliest event, or None if the
+        queue is empty.
+        """
+        self._sort()
+        main, head, run = self._main, self._head, self._run
+
+        if head == len(main[0]):
+            if not len(run[0]):
+                return None
+            return False, 0
+        if not len(run[0]) or (main[0][head], main[1][head]) <= (run[0][0], run[1][0]):
+            return True, head
+        return False, 0
+
+    def getNextEvent(self):
+        """
+        Returns the newest event, leaving it on the queue (if an event exists)
+        """
+        position = self._getNextPosition()
+        if position is None:
+            return None
+
+        inMain, index = position
+        if inMain:
+            return self._payloads[self._main[2][index]]
+        return self._payloads[self._run[2][index]]
+
+    def popNextEvent(self):
+        """
+        Returns the newest event while removing it (if an event exists)
+        """
+        position = self._getNextPosition()
+        if position is None:
+            return None
+
+        inMain, index = position
+        if inMain:
+            payloadIndices = self._main[2][index:index+1]
+            self._head += 1
+        else:
+            payloadIndices = self._run[2][:1]
+            self._run = tuple(a[1:] for a in self._run)
+        return self._takePayloads(payloadIndices)[0]
+
+    def getEventCount(self):
+        """
+        Returns the amount of events on the queue
+        """
+        return len(self._main[0]) - self._head + len(self._run[0]) + \
+            len(self._stagedTimes)
+
+    def getEventIterator(self):
+        """
+        Returns an iterator object for all of the events on the queue,
+        in the order they will be executed
+        """
+        self._sort()
+        main = tuple(a[self._head:] for a in self._main)
+        times, sequences, payloadIndices = _mergeRuns(main, self._run)
+        return iter(self._payloads[payloadIndices].tolist())
@@ -0,0 +1,364 @@
+"""
+Async Networking
+--------------------
+Summary: A server and client on IOLoops whose requests return Futures
+and whose processInput may be a coroutine.
+
+An AsyncClient does not need a thread of its own: every AsyncClient in
+a process shares one IOLoop by default, so a single process can hold
+thousands of connections, for instance to load test a server.  A client
+which cannot connect raises socket.error instead of exiting.
+
+sendRequest returns a Future for the reply.  Since the wire protocol has
+no request IDs, replies are matched to requests in the order they were
+sent.  Messages which arrive while no request is waiting go to
+processInput as usual.
+
+processInput may be written as a coroutine: a generator which yields
+Futures and is resumed with their results once they are done, and which
+ends with 'raise Return(value)' instead of returning a value.  A
+connection only starts processing its next message once the coroutine
+for the previous one has finished, so messages are handled in order
+without blocking the loop in the meantime:
+
+    class ProxyServer(AsyncServer):
+        def processInput(self, sockThrd, data):
+            reply = yield self.backend.sendRequest(data)
+            sockThrd.write(reply)
+
+Ordinary processInput methods which return nothing work unchanged, so
+an existing Server subclass is made asynchronous by mixing AsyncServer
+in first, which makeAsync does.  An ordinary processInput blocks the
+loop while it runs, like any other code on the loop thread.
+
+processTimedInput is called as before and is not run as a coroutine.
+"""
+
+import socket, errno, threading, types
+from collections import deque
+
+import Networking
+
+class Timeout(Exception):
+    """Raised by Future.result when the future is not done in time."""
+
+class Return(Exception):
+    """
+    Raised by a coroutine to finish with 'value', since generators
+    cannot return values.
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class Future(object):
+    """
+    The result of an operation which has not finished yet.  Results may
+    be waited for with result, or handled by done callbacks, which are
+    called on the thread which finishes the future.
+    """
+
+    def __init__(self):
+
+        self._condition = threading.Condition(threading.Lock())
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def setResult(self, result):
+        self._finish(result, None)
+
+    def setException(self, exception):
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+
+        self._condition.acquire()
+        try:
+            if self._done:
+                return
+            self._result, self._exception = result, exception
+            self._done = True
+            self._condition.notifyAll()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._condition.release()
+
+        for callback in callbacks:
+            callback(self)
+
+    def addDoneCallback(self, callback):
+        """
+        Calls callback(future) once the future is done, at once if it
+        already is.
+        """
+        self._condition.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._condition.release()
+        callback(self)
+
+    def _wait(self, timeout):
+
+        self._condition.acquire()
+        try:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise Timeout('Future was not done within %r seconds' % timeout)
+        finally:
+            self._condition.release()
+
+    def result(self, timeout=None):
+        """
+        Waits up to 'timeout' seconds (forever if None) for the future,
+        and returns its result or raises its exception.  Must not be
+        called on the thread of the IOLoop which would finish it.
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Waits like result, and returns the exception of the future, or
+        None if it succeeded.
+        """
+        self._wait(timeout)
+        return self._exception
+
+class _Task(object):
+    """
+    Runs a generator as a coroutine on an IOLoop.
+    """
+
+    def __init__(self, loop, generator):
+
+        self.loop = loop
+        self.generator = generator
+        self.future = Future()
+
+    def step(self, value, exception):
+
+        try:
+            if exception is None:
+                yielded = self.generator.send(value)
+            else:
+                yielded = self.generator.throw(exception)
+        except StopIteration:
+            self.future.setResult(None)
+            return
+        except Return, r:
+            self.future.setResult(r.value)
+            return
+        except Exception, e:
+            self.future.setException(e)
+            return
+
+        if isinstance(yielded, Future):
+            yielded.addDoneCallback(self._resume)
+        else:
+            self.loop.callSoon(self.step, None,
+                TypeError('Coroutines may only yield Futures, not %r' % (yielded,)))
+
+    def _resume(self, future):
+
+        self.loop.callSoon(self.step, future._result, future._exception)
+
+def spawn(loop, generator):
+    """
+    Runs 'generator' as a coroutine on the IOLoop 'loop'.  Returns a
+    Future for the value it finishes with.
+    """
+    task = _Task(loop, generator)
+    loop.callSoon(task.step, None, None)
+    return task.future
+
+_defaultLoop = None
+_defaultLoopLock = threading.Lock()
+
+def getDefaultLoop():
+    """
+    Returns the IOLoop shared by the AsyncClients which are not given
+    one, starting it if necessary.
+    """
+    global _defaultLoop
+    _defaultLoopLock.acquire()
+    try:
+        if _defaultLoop is None or not _defaultLoop.running:
+            _defaultLoop = Networking.IOLoop()
+        return _defaultLoop
+    finally:
+        _defaultLoopLock.release()
+
+class AsyncConnection(Networking.SelectorConnection):
+    """
+    Inherits from SelectorConnection
+
+    A connection which matches replies to requests and runs coroutine
+    processInput methods.
+    """
+
+    def __init__(self,parent,sock,loop):
+        Networking.SelectorConnection.__init__(self, parent, sock, loop)
+
+        # Futures waiting for replies, in the order they were requested
+        self._replies = deque()
+        self._requestLock = threading.Lock()
+
+        # messages waiting for the processInput of an earlier one
+        self._inputs = deque()
+        self._processing = False
+
+    def sendRequest(self, message):
+        """
+        Sends 'message' and returns a Future for the reply.
+        """
+        future = Future()
+        self._requestLock.acquire()
+        try:
+            # the reply cannot arrive before the future is waiting
+            self._replies.append(future)
+            try:
+                self.write(message)
+            except Exception, e:
+                self._replies.remove(future)
+                future.setException(e)
+        finally:
+            self._requestLock.release()
+        return future
+
+    def dispatchInput(self, line):
+
+        #replies and waiting messages outlive the receive buffer
+        if isinstance(line, memoryview):
+            line = line.tobytes()
+
+        if self._replies:
+            self._replies.popleft().setResult(line)
+            return
+
+        self._inputs.append(line)
+        if not self._processing:
+            self._processInputs()
+
+    def _processInputs(self):
+        """
+        Calls processInput for the waiting messages until one of them
+        turns out to be a coroutine, which the rest then wait for.
+        """
+        inputs = self._inputs
+        while inputs and self.alive:
+            result = self.parent.processInput(self, inputs.popleft())
+            if isinstance(result, types.GeneratorType):
+                self._processing = True
+                spawn(self.loop, result).addDoneCallback(self._inputDone)
+                return
+        self._processing = False
+
+    def _inputDone(self, future):
+
+        if future._exception is not None:
+            print 'processInput of %s failed: %r' % (self, future._exception)
+        self.loop.callSoon(self._processInputs)
+
+    def close(self, notifyPeer=True):
+
+        Networking.SelectorConnection.close(self, notifyPeer)
+
+        #nothing will answer the requests which are still waiting
+        while self._replies:
+            self._replies.popleft().setException(
+                socket.error(errno.ECONNRESET, 'Connection was closed'))
+
+class AsyncServer(Networking.Server):
+    """
+    Inherits from Server
+
+    A server whose clients are AsyncConnections on 'ioThreads' IOLoops.
+    Its processInput may be a coroutine, and its clients' sendRequest
+    returns a Future.
+
+    AsyncServer defines no processInput of its own, so it can be mixed
+    into an existing Server subclass, e.g.
+    class AsyncEchoServer(AsyncServer, EchoServer).
+    """
+
+    def __init__(self, host='', port=51423, ioThreads=1):
+        if ioThreads < 1:
+            raise ValueError('AsyncServer needs at least one IO thread')
+        Networking.Server.__init__(self, host, port, ioThreads)
+
+    def createConnection(self, clientSocket, loop):
+        return AsyncConnection(self, clientSocket, loop)
+
+def makeAsync(serverClass):
+    """
+    Returns a subclass of the Server subclass 'serverClass' which serves
+    its clients like an AsyncServer, so that existing servers run on
+    IOLoops without any changes.
+    """
+    return type('Async' + serverClass.__name__, (AsyncServer, serverClass), {})
+
+class AsyncClient(Networking.NetworkEntity):
+    """
+    Inherits from NetworkEntity
+
+    A client whose connection is served by an IOLoop, by default the
+    one shared by every AsyncClient.  sendRequest returns a Future for
+    the reply, and processInput, which receives the messages that are
+    not replies, may be a coroutine.
+
+    Messages which expect no reply should be sent with write, so that
+    they do not take the replies of later requests.
+
+    @param loop: the IOLoop which serves the connection
+    @type loop: IOLoop
+
+    @param socketThread: the connection to the server
+    @type socketThread: AsyncConnection
+
+    @param framing: the framing to ask the server for, as with Client
+    @type framing: int
+    """
+
+    def __init__(self, host='localhost', port=51423, loop=None,
+                 framing=Networking.LEGACY_FRAMING):
+        Networking.NetworkEntity.__init__(self, host, port)
+
+        if loop is None: loop = getDefaultLoop()
+        self.loop = loop
+
+        #raises socket.error if the server cannot be reached
+        sock = socket.create_connection((self.host, self.port))
+        self.socketThread = AsyncConnection(self, sock, loop)
+        self.socketThread.start()
+        if framing != Networking.LEGACY_FRAMING:
+            self.socketThread.requestFraming(framing)
+
+    def sendRequest(self, request):
+        """
+        Sends 'request' to the server and returns a Future for the
+        reply.
+        """
+        return self.socketThread.sendRequest(request)
+
+    def write(self, message):
+        """
+        Sends 'message' to the server without waiting for a reply.
+        """
+        self.socketThread.write(message)
+
+    def close(self):
+        """
+        Closes the connection to the server.
+        """
+        self.socketThread.close()
@@ -1,18 +1,67 @@
 from Timing import mostAccurateTime
+import itertools
 
-class TimedEvent:
+# numbers events in the order they are created, so that events with equal
+# times can be ordered first come, first served
+_eventSequence = itertools.count()
+
+class TimedEvent(object):
+    
+    __slots__ = ('time', 'sequence')
     
     def __init__(self):
         
         self.time = mostAccurateTime()
+        self.sequence = next(_eventSequence)
         
     def getTime(self):
         """Returns time for the event to execute."""
         return self.time
         
+    def execute(self):
+        """
+        Performs the event's state change.  Subclasses override this.
+        """
+        pass
+
+    def getCoalescingKey(self):
+        """
+        Returns a key, such as (object ID, attribute name), shared by the
+        absolute events which overwrite each other's change, or None for
+        delta events, which must all be executed.
+        """
+        return None
+
+    def getLane(self):
+        """
+        Returns the priority lane of a LanedEventQueue the event belongs
+        in, or None for the queue's default lane.
+        """
+        return None
+
+    def getTargetID(self):
+        """
+        Returns the ID of the NetworkObject the event changes, or None if
+        the event does not belong to a single object.
+        """
+        return None
+
+    def applyTo(self, obj):
+        """
+        Performs the event's state change on 'obj', the object with the
+        event's target ID.  Subclasses with a target override this.
+        """
+        self.execute()
+
+    def getSortKey(self):
+        """
+        Returns the (time, sequence) tuple which events are ordered by.
+        """
+        return (self.time, self.sequence)
+        
     def __cmp__(self, other):
         """Compares two TimedEvents."""
-        return self.getTime() > other.getTime()
+        return cmp(self.getSortKey(), other.getSortKey())
         
 """
 Event Module
@@ -42,110 +91,1778 @@ event
 
 """
 
-import time
+import time, threading, traceback
+
+import Instrumentation
 
 class Manager:
+    """
+    Executes due events on a pool of Executor threads.  The pool grows,
+    up to 'maxExecutors', while events are waiting for an executor, and
+    executors which have had no event for 'idleTimeout' seconds die, so
+    an idle manager holds no threads at all.
+    
+    Events are taken from 'queue', which may be any AbstractQueue with a
+    getNextEvents method.  By default a ShardedEventQueue is used, so
+    events may be added from any thread, including from executors.
+    Each event is executed by calling handler(event), which defaults to
+    calling the event's execute method.
+    
+    Events which are due at the same tick are executed concurrently, so
+    events which must happen in order should be wrapped in a single
+    event.
+    """
 
-    def __init__(self):
+    def __init__(self, queue=None, maxExecutors=4, idleTimeout=1.0,
+                 handler=None):
         #Create the event Queue, or register with it, as the case may be
-        pass
+        if queue is None: queue = ShardedEventQueue()
+        if handler is None: handler = _executeEvent
+        
+        self.queue = queue
+        self.maxExecutors = maxExecutors
+        self.idleTimeout = idleTimeout
+        self.handler = handler
+        
+        # due events waiting for an executor
+        self._work = Queue.Queue()
+        # guards _executors, _idleCount and _pendingCount
+        self._lock = threading.Lock()
+        self._executors = []
+        # executors waiting for an event, including new ones which have
+        # not reached the queue yet
+        self._idleCount = 0
+        # dispatched events which no executor has taken yet
+        self._pendingCount = 0
 
     def addEvent(self, event):
         #Add event to the queue
+        return self.queue.addEvent(event)
+    
+    def addEvents(self, events):
+        """
+        Adds every event in the iterable 'events' to the queue at once.
+        """
+        return self.queue.addEvents(events)
+
+    def tick(self, currentTime=None):
+        """
+        Called as often as possible, at the system management level.
+        Hands every event which is due by currentTime to the executors.
+        Returns the number of events dispatched.
+        """
+        return self._dispatch(self.queue.getNextEvents(currentTime))
+    
+    def waitAndTick(self, timeout=None):
+        """
+        Sleeps until events are due, or until 'timeout' seconds have
+        passed, and hands the due events to the executors.  The queue
+        must be a WaitableQueue.  Returns the number of events
+        dispatched.
+        """
+        return self._dispatch(self.queue.waitForNextEvents(timeout))
+    
+    def _dispatch(self, events):
+        """
+        Hands 'events' to the executors, starting new executors if there
+        are not enough idle ones.  Returns the number of events.
+        """
+        if not events:
+            return 0
+        
+        if Instrumentation.enabled:
+            self._recordDispatch(events)
+        
+        # executors update both counts together while holding the lock,
+        # so every idle executor counted here will take one of the
+        # pending events
+        put = self._work.put
+        self._lock.acquire()
+        try:
+            for event in events:
+                put(event)
+            self._pendingCount += len(events)
+            newCount = min(self._pendingCount - self._idleCount,
+                           self.maxExecutors - len(self._executors))
+            for i in xrange(newCount):
+                self._executors.append(Executor(self))
+                self._idleCount += 1
+        finally:
+            self._lock.release()
+        
+        return len(events)
+    
+    def _recordDispatch(self, events):
+        """
+        Records how late each of 'events' is being dispatched, and the
+        depth of the queue.
+        """
+        now = Timing.mostAccurateTime()
+        observe = Instrumentation.histogram('manager.lateness').observe
+        for event in events:
+            observe(max(now - event.getTime(), 0.0))
+        Instrumentation.gauge('manager.queueDepth').set(self.getQueueDepth())
+    
+    def shutdown(self, wait=True):
+        """
+        Stops every executor once the events already dispatched to them
+        have been executed.  Events still on the queue are not executed.
+        """
+        self._lock.acquire()
+        try:
+            executors = list(self._executors)
+        finally:
+            self._lock.release()
+        
+        for executor in executors:
+            self._work.put(None)
+        if wait:
+            for executor in executors:
+                executor.join()
+    
+    def getQueueDepth(self):
+        """
+        Returns the number of events which have not started executing,
+        both those on the queue and those waiting for an executor.
+        """
+        return self.queue.getEventCount() + self._work.qsize()
+    
+    def getPendingCount(self):
+        """
+        Returns the number of due events waiting for an executor.
+        """
+        return self._work.qsize()
+    
+    def getBusyExecutorCount(self):
+        """
+        Returns the number of executors which are executing an event.
+        """
+        return len(self._executors) - self._idleCount
+    
+    def getExecutorCount(self):
+        """
+        Returns the number of executors which are alive.
+        """
+        return len(self._executors)
+    
+    def _retireExecutor(self, executor, force=False):
+        """
+        Called by an executor which has had no work for idleTimeout
+        seconds.  Returns True if the executor should die, or False if
+        work arrived in the meantime.  With 'force', the executor always
+        dies.
+        """
+        self._lock.acquire()
+        try:
+            if not force:
+                if self._pendingCount:
+                    return False
+                # a forced executor stopped being idle when it took the
+                # shutdown request
+                self._idleCount -= 1
+            self._executors.remove(executor)
+            return True
+        finally:
+            self._lock.release()
+    
+    def _takeEvent(self, event):
+        """
+        Called by an executor as soon as it has taken 'event', or the
+        shutdown request None, from the work queue.
+        """
+        self._lock.acquire()
+        try:
+            self._idleCount -= 1
+            if event is not None:
+                self._pendingCount -= 1
+        finally:
+            self._lock.release()
+    
+    def _setIdle(self):
+        """
+        Called by an executor before it waits for its next event.
+        """
+        self._lock.acquire()
+        try:
+            self._idleCount += 1
+        finally:
+            self._lock.release()
+
+def _executeEvent(event):
+    
+    event.execute()
+
+class AbstractQueue:
+    def __init__(self):
+        """
+        Sets up the event queue using a currently undefined structure
+        (possibly a mix of a dictionary and an array????)
+        """
+        pass
+
+    def addEvent(self,event):
+        """
+        Adds 'event' chronologically to the queue.  Queues which support
+        cancelling events return an EventHandle for it.
+        """
+        pass
+
+    def addEvents(self,events):
+        """
+        Adds every event in the iterable 'events' to the queue in a single
+        operation.  Returns a list with the result of addEvent for each
+        event.
+        """
+        pass
+
+    def popNextEvent(self):
+        """
+        Returns the newest event while removing it (if an event exists)
+        """
+        pass
+
+    def getNextEvent(self):
+        """
+        Returns the newest event, leaving it on the queue (if an event exists)
+        """
+        pass
+
+    def getEventCount(self):
+        """
+        Returns the amount of events on the queue
+        """
+        # (Dev Note: remember, direct object access by 
+        # an external system is BAD for extensibility and modular design)
         pass
 
-    def tick(self):
-        #Called as often as possible, at the system management level
+    def getEventAtIndex(self,index):
+        """
+        Returns the event at the given index, if it exists.
+        """
+        pass
+
+    def removeEventAtIndex(self,index):
+        """
+        Destroys the event at index, returning nothing
+        """
+        pass
+
+    def getEventIterator(self):
+        """
+        Returns an iterator object for all of the events on the queue
+        """
+        pass
+
+    def cancelEvent(self, handle):
+        """
+        Removes the event belonging to 'handle' (as returned by addEvent)
+        from the queue.  Returns True if the event was still pending.
+        """
+        pass
+
+    def rescheduleEvent(self, handle, newTime):
+        """
+        Moves the event belonging to 'handle' to 'newTime'.  Returns True
+        if the event was still pending.
+        """
+        pass
+
+class Executor(threading.Thread):
+    """
+    A daemon thread which executes the events a Manager dispatches to
+    it, so that it does not interrupt standard execution flow.
+    
+    Executors die if they have no event for the manager's idleTimeout.
+    """
+    
+    def __init__(self, manager):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        
+        self.manager = manager
+        self.start()
+    
+    def run(self):
+        
+        manager = self.manager
+        get = manager._work.get
+        
+        while True:
+            try:
+                event = get(True, manager.idleTimeout)
+            except Queue.Empty:
+                if manager._retireExecutor(self):
+                    return
+                continue
+            
+            manager._takeEvent(event)
+            if event is None:
+                # shutdown
+                manager._retireExecutor(self, True)
+                return
+            
+            startTime = None
+            if Instrumentation.enabled:
+                startTime = Timing.mostAccurateTime()
+            try:
+                try:
+                    manager.handler(event)
+                except Exception:
+                    # a failing event must not take the executor down
+                    traceback.print_exc()
+            finally:
+                if startTime is not None:
+                    Instrumentation.histogram('manager.handlerTime.' +
+                        event.__class__.__name__).observe(
+                            Timing.mostAccurateTime() - startTime)
+                manager._setIdle()
+
+import Queue, Timing, random
+
+from heapq import heappush, heappop, heapify
+class HeapSortList:
+    
+    def __init__(self):
+        
+        self._list = []
+    
+    def append(self, item):
+        heappush(self._list, item)
+    
+    def extend(self, items):
+        """
+        Adds a batch of items.  'items' is sorted first, which is nearly
+        free for an already sorted run, and is then used as the heap
+        directly, heapified together with the existing items, or pushed
+        item by item, whichever is cheapest for the relative sizes.
+        """
+        items = sorted(items)
+        if not self._list:
+            # a sorted list is already a heap
+            self._list = items
+        elif len(items)*4 > len(self._list):
+            self._list.extend(items)
+            heapify(self._list)
+        else:
+            for item in items:
+                heappush(self._list, item)
+    
+    def pop(self):
+        return heappop(self._list)
+    
+    def peek(self):
+        return self._list[0]
+    
+    def retain(self, keep):
+        """
+        Removes every item for which keep(item) is False.
+        """
+        self._list = [item for item in self._list if keep(item)]
+        heapify(self._list)
+        
+    def __len__(self):
+        return len(self._list)
+        
+    def __iter__(self):
+        return iter(self._list)
+
+class _SkipNode(object):
+    
+    __slots__ = ('value', 'next', 'width')
+    
+    def __init__(self, value, height):
+        
+        self.value = value
+        self.next = [None]*height
+        # number of items between this node and next[level], counting
+        # the next node itself; meaningless where next[level] is None
+        self.width = [1]*height
+
+class IndexableSkipList:
+    """
+    A sorted list with O(log n) insertion, removal, indexing and
+    searching.  Every link of the skip list also records how many items
+    it jumps over, so the n-th item can be found by following links
+    instead of walking the list.
+    """
+    
+    maxHeight = 32
+    
+    def __init__(self):
+        
+        self._head = _SkipNode(None, self.maxHeight)
+        self._height = 1
+        self._size = 0
+    
+    def _randomHeight(self):
+        
+        height = 1
+        while height < self.maxHeight and random.random() < 0.5:
+            height += 1
+        return height
+    
+    def _findChain(self, value, inclusive):
+        """
+        Returns the last node on each level before 'value' (or, with
+        'inclusive', at or before it), and the indices of those nodes,
+        where the head has index -1.
+        """
+        chain = [self._head]*self.maxHeight
+        positions = [-1]*self.maxHeight
+        node = self._head
+        position = -1
+        for level in xrange(self._height-1, -1, -1):
+            nextNode = node.next[level]
+            while nextNode is not None and \
+                    (nextNode.value <= value if inclusive else nextNode.value < value):
+                position += node.width[level]
+                node = nextNode
+                nextNode = node.next[level]
+            chain[level] = node
+            positions[level] = position
+        return chain, positions
+    
+    def insert(self, value):
+        """
+        Adds 'value' after every item which is less than or equal to it.
+        """
+        chain, positions = self._findChain(value, True)
+        newPosition = positions[0] + 1
+        height = self._randomHeight()
+        if height > self._height:
+            self._height = height
+        
+        newNode = _SkipNode(value, height)
+        for level in xrange(height):
+            previous = chain[level]
+            newNode.next[level] = previous.next[level]
+            newNode.width[level] = positions[level] + previous.width[level] + 1 - newPosition
+            previous.next[level] = newNode
+            previous.width[level] = newPosition - positions[level]
+        for level in xrange(height, self._height):
+            chain[level].width[level] += 1
+        
+        self._size += 1
+    
+    def _unlink(self, node, chain):
+        
+        height = len(node.next)
+        for level in xrange(height):
+            previous = chain[level]
+            previous.next[level] = node.next[level]
+            previous.width[level] += node.width[level] - 1
+        for level in xrange(height, self._height):
+            chain[level].width[level] -= 1
+        self._size -= 1
+    
+    def remove(self, value):
+        """
+        Removes the item which is 'value' itself.
+        """
+        chain, positions = self._findChain(value, False)
+        node = chain[0].next[0]
+        # items which compare equal to 'value' may come first
+        while node is not None and node.value is not value and \
+                not value < node.value:
+            for level in xrange(len(node.next)):
+                chain[level] = node
+            node = node.next[0]
+        if node is None or node.value is not value:
+            raise ValueError('IndexableSkipList.remove(x): x not in list')
+        self._unlink(node, chain)
+    
+    def popFirst(self):
+        """
+        Removes and returns the smallest item.
+        """
+        node = self._head.next[0]
+        if node is None:
+            raise IndexError('pop from empty list')
+        self._unlink(node, [self._head]*self._height)
+        return node.value
+    
+    def first(self):
+        
+        node = self._head.next[0]
+        if node is None:
+            raise IndexError('list is empty')
+        return node.value
+    
+    def _nodeAt(self, index):
+        
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError('list index out of range')
+        
+        node = self._head
+        remaining = index + 1
+        for level in xrange(self._height-1, -1, -1):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+            if not remaining:
+                break
+        return node
+    
+    def __getitem__(self, index):
+        
+        return self._nodeAt(index).value
+    
+    def pop(self, index):
+        """
+        Removes and returns the item at 'index'.
+        """
+        value = self._nodeAt(index).value
+        self.remove(value)
+        return value
+    
+    def bisectLeft(self, value):
+        """
+        Returns the index of the first item which is not less than 'value'.
+        """
+        chain, positions = self._findChain(value, False)
+        return positions[0] + 1
+    
+    def iterFrom(self, value):
+        """
+        Iterates over the items which are not less than 'value', in order.
+        """
+        chain, positions = self._findChain(value, False)
+        node = chain[0].next[0]
+        while node is not None:
+            yield node.value
+            node = node.next[0]
+    
+    def __iter__(self):
+        
+        node = self._head.next[0]
+        while node is not None:
+            yield node.value
+            node = node.next[0]
+    
+    def __len__(self):
+        return self._size
+
+class EventRecord(list):
+    """
+    The entry a queue keeps for each event: [time, sequence, event],
+    where sequence numbers the events in the order they were added to
+    the queue.  Records compare as plain lists, so queues order events by
+    (time, sequence) without calling back into the events, and events
+    with equal times come out in the order they were added.  Records
+    have no instance dictionary.
+    
+    Queues which support cancelling events set the event of a record to
+    None once it has been cancelled or returned.
+    """
+    
+    __slots__ = ()
+
+class EventHandle:
+    """
+    Returned by the addEvent method of queues which support cancelling
+    events.  The handle lets the owner of an event cancel it or move it
+    to a different time without searching the queue for it.
+    """
+    
+    def __init__(self, queue, entry):
+        
+        self._queue = queue
+        self._entry = entry
+        self._event = entry[2]
+    
+    def getEvent(self):
+        """Returns the event this handle belongs to."""
+        return self._event
+    
+    def isPending(self):
+        """
+        Returns True if the event is still waiting on the queue, False
+        if it has been cancelled or already returned by the queue.
+        """
+        return self._entry[2] is not None
+    
+    def cancel(self):
+        """
+        Removes the event from the queue.  Returns True if the event was
+        still pending.
+        """
+        return self._queue.cancelEvent(self)
+    
+    def reschedule(self, newTime):
+        """
+        Moves the event to 'newTime', updating the event's time
+        attribute.  Returns True if the event was still pending and the
+        queue accepted the new time.
+        """
+        return self._queue.rescheduleEvent(self, newTime)
+
+class CancellableQueue(AbstractQueue):
+    """
+    Base class for queues which return an EventHandle from addEvent.
+    
+    Events are stored in EventRecord entries, so entries sort by time and
+    then by the order they were added without ever comparing the events
+    themselves.  Cancelling an event only
+    clears the event from its entry (lazy deletion), and the queue skips
+    cleared entries when they reach the front.  Once cancelled entries
+    outnumber the pending ones, compact() throws them away so that
+    memory does not grow without bound.
+    
+    Subclasses implement _fileEntry, which places a new entry on the
+    queue, and compact.  The event of an entry is cleared as well when
+    the queue returns it, so that handles know it is no longer pending.
+    """
+    
+    # cancelled entries are left in place until there are at least this many
+    minimumCompactionSize = 64
+    
+    def __init__(self):
+        
+        self._sequence = itertools.count()
+        self._eventCount = 0
+        self._removedCount = 0
+        
+        # see setCoalescingWindow
+        self.coalescingWindow = None
+        self._coalescing = {}
+        self.coalescedCount = 0
+    
+    def setCoalescingWindow(self, window):
+        """
+        Makes absolute events coalesce: when an event with a coalescing
+        key is added, a pending event with the same key and an earlier
+        time in the same 'window' seconds is cancelled, so only the last
+        absolute change is executed.  An event which arrives late, with
+        an earlier time than the pending event of its key and window, is
+        already superseded, so it is cancelled itself as soon as it is
+        added.  Delta events, and events in later windows, are never
+        affected.  A window of None turns coalescing off.
+        """
+        self.coalescingWindow = window
+        self._coalescing = {}
+    
+    def _coalesce(self, event, eventTime, handle):
+        """
+        Cancels whichever of 'event', with 'handle', and the pending event
+        with the same key and window is earlier, so that the pending
+        event of a key is always the latest.
+        """
+        key = event.getCoalescingKey()
+        if key is None:
+            return
+        
+        coalescingWindow = self.coalescingWindow
+        coalescing = self._coalescing
+        pending = coalescing.get(key)
+        # the window of the pending event is taken from its current time,
+        # since rescheduleEvent may have moved it to another window
+        if pending is not None and pending.isPending() and \
+                int(pending._entry[0] // coalescingWindow) == \
+                int(eventTime // coalescingWindow):
+            if pending._entry[0] > eventTime:
+                # a late arrival, which the pending event supersedes
+                self.cancelEvent(handle)
+                self.coalescedCount += 1
+                return
+            self.cancelEvent(pending)
+            self.coalescedCount += 1
+        coalescing[key] = handle
+        
+        if len(coalescing) > 2*self._eventCount + self.minimumCompactionSize:
+            self._purgeCoalescing()
+    
+    def _purgeCoalescing(self):
+        """
+        Forgets the coalescing keys whose events are no longer pending.
+        """
+        self._coalescing = dict((key, pending) for key, pending
+                                in self._coalescing.iteritems()
+                                if pending.isPending())
+    
+    def _isTimeAccepted(self, eventTime):
+        """
+        Returns False if events at 'eventTime' can no longer be executed
+        by the queue.
+        """
+        return True
+    
+    def _fileEntry(self, entry):
+        """
+        Places 'entry' on the queue.
+        """
+        raise NotImplementedError
+    
+    def _fileEntries(self, entries):
+        """
+        Places every entry in the list 'entries' on the queue.  Subclasses
+        override this when a batch can be filed more cheaply than one
+        entry at a time.
+        """
+        for entry in entries:
+            self._fileEntry(entry)
+    
+    def compact(self):
+        """
+        Removes the entries of cancelled events from the queue.
+        """
+        raise NotImplementedError
+    
+    def addEvent(self,event):
+        """
+        Adds 'event' chronologically to the queue.  Returns an EventHandle
+        for the event, or False if the event was missed.
+        """
+        eventTime = event.getTime()
+        if not self._isTimeAccepted(eventTime):
+            print 'Warning: event missed.'
+            return False
+        
+        entry = EventRecord((eventTime, next(self._sequence), event))
+        self._fileEntry(entry)
+        self._eventCount += 1
+        handle = EventHandle(self, entry)
+        if self.coalescingWindow is not None:
+            self._coalesce(event, eventTime, handle)
+        return handle
+    
+    def addEvents(self,events):
+        """
+        Adds every event in the iterable 'events' to the queue in a single
+        operation.  Returns a list with an EventHandle, or False if the
+        event was missed, for each event.
+        """
+        if self.coalescingWindow is not None:
+            # events in the batch may replace each other
+            return [self.addEvent(event) for event in events]
+        
+        handles = []
+        appendToHandles = handles.append
+        entries = []
+        appendToEntries = entries.append
+        nextSequence = self._sequence.next
+        isTimeAccepted = self._isTimeAccepted
+        
+        for event in events:
+            eventTime = event.getTime()
+            if isTimeAccepted(eventTime):
+                entry = EventRecord((eventTime, nextSequence(), event))
+                appendToEntries(entry)
+                appendToHandles(EventHandle(self, entry))
+            else:
+                print 'Warning: event missed.'
+                appendToHandles(False)
+        
+        self._fileEntries(entries)
+        self._eventCount += len(entries)
+        return handles
+    
+    def cancelEvent(self, handle):
+        """
+        Removes the event belonging to 'handle' from the queue.  Returns
+        True if the event was still pending.
+        """
+        entry = handle._entry
+        if entry[2] is None:
+            return False
+        
+        entry[2] = None
+        self._eventCount -= 1
+        self._removedCount += 1
+        if self._removedCount > self.minimumCompactionSize and \
+                self._removedCount > self._eventCount:
+            self.compact()
+        return True
+    
+    def rescheduleEvent(self, handle, newTime):
+        """
+        Moves the event belonging to 'handle' to 'newTime'.  Returns True
+        if the event was still pending and 'newTime' was accepted.
+        """
+        event = handle._entry[2]
+        if event is None or not self._isTimeAccepted(newTime):
+            return False
+        
+        self.cancelEvent(handle)
+        event.time = newTime
+        handle._entry = entry = EventRecord((newTime, next(self._sequence), event))
+        self._fileEntry(entry)
+        self._eventCount += 1
+        return True
+    
+    def _takeEvent(self, entry):
+        """
+        Clears 'entry' as it leaves the queue and returns its event, or
+        None if the event was cancelled.
+        """
+        event = entry[2]
+        if event is None:
+            self._removedCount -= 1
+        else:
+            entry[2] = None
+            self._eventCount -= 1
+        return event
+    
+    def getEventCount(self):
+        """
+        Returns the amount of events on the queue
+        """
+        return self._eventCount
+
+class TimingWheelEventQueue(CancellableQueue):
+    """
+    A hierarchical timing wheel.  Time is divided into ticks of
+    'tickResolution' seconds.  Level 0 has one slot per tick, and every
+    higher level has slots which each cover a full rotation of the level
+    below it.  Adding an event drops it into a single slot, and events
+    are only cascaded down a level when the wheel turns past the start of
+    their slot, so inserting and expiring events are O(1) amortized.
+    Events too far in the future for the top wheel wait in an overflow
+    heap until the top wheel has turned far enough.
+    
+    Unlike EventQueue, events which are already due when they are added
+    are not dropped; they are executed on the next call to getNextEvents.
+    """
+    
+    def __init__(self, startTime = None, tickResolution = 0.001,
+                 slotBits = 8, levelCount = 4):
+        """
+        Sets up the wheels.  Each of the 'levelCount' wheels has
+        2**slotBits slots, so the wheels cover
+        tickResolution * 2**(slotBits*levelCount) seconds before events
+        have to be parked in the overflow heap.
+        """
+        CancellableQueue.__init__(self)
+        
+        if startTime is None: startTime = Timing.mostAccurateTime()
+        
+        self.tickResolution = float(tickResolution)
+        self._slotBits = slotBits
+        self._slotMask = (1 << slotBits) - 1
+        self._levelCount = levelCount
+        
+        self._wheels = [ [ [] for slot in xrange(1 << slotBits) ]
+                         for level in xrange(levelCount) ]
+        # number of entries stored in each wheel (including cancelled
+        # ones), used to skip empty wheels
+        self._levelCounts = [0]*levelCount
+        # heap of entries beyond the top wheel
+        self._overflow = []
+        
+        self.currentTick = self._getTick(startTime)
+    
+    def _getTick(self, eventTime):
+        
+        return int(eventTime / self.tickResolution)
+    
+    def _fileEntry(self, entry):
+        
+        self._file(entry, self._getTick(entry[0]))
+    
+    def _locate(self, eventTick):
+        """
+        Returns (level, slot) of the lowest wheel that can hold events at
+        'eventTick' relative to the current tick, or (None, None) if the
+        tick is beyond the top wheel.
+        """
+        currentTick = self.currentTick
+        slotBits = self._slotBits
+        
+        if eventTick <= currentTick:
+            # due already; it will be expired with the current slot
+            return 0, currentTick & self._slotMask
+        
+        for level in xrange(self._levelCount):
+            shift = slotBits*(level+1)
+            if (eventTick >> shift) == (currentTick >> shift):
+                return level, (eventTick >> (slotBits*level)) & self._slotMask
+        
+        return None, None
+    
+    def _file(self, entry, eventTick):
+        """
+        Places 'entry' in the lowest wheel that can hold it relative to
+        the current tick.
+        """
+        level, slot = self._locate(eventTick)
+        if level is None:
+            heappush(self._overflow, entry)
+        else:
+            self._wheels[level][slot].append(entry)
+            self._levelCounts[level] += 1
+    
+    def _fileEntries(self, entries):
+        """
+        Files a batch of entries with one slot lookup per distinct tick.
+        """
+        tickResolution = self.tickResolution
+        levelCounts = self._levelCounts
+        overflow = self._overflow
+        slotsByTick = {}
+        
+        for entry in entries:
+            eventTick = int(entry[0] / tickResolution)
+            located = slotsByTick.get(eventTick)
+            if located is None:
+                level, slot = self._locate(eventTick)
+                if level is None:
+                    heappush(overflow, entry)
+                    continue
+                located = slotsByTick[eventTick] = (level, self._wheels[level][slot])
+            located[1].append(entry)
+            levelCounts[located[0]] += 1
+    
+    def _cascade(self):
+        """
+        Called whenever the current tick reaches the start of a level 1
+        slot.  Moves the entries in every higher slot which starts at the
+        current tick down to the wheels below it.
+        """
+        currentTick = self.currentTick
+        slotBits = self._slotBits
+        getTick = self._getTick
+        
+        level = 1
+        while level < self._levelCount and \
+                not currentTick & ((1 << (slotBits*level)) - 1):
+            level += 1
+        
+        # 'level' is now the first wheel whose slot did not change
+        if level == self._levelCount and \
+                not currentTick & ((1 << (slotBits*level)) - 1):
+            overflow = self._overflow
+            topShift = slotBits*self._levelCount
+            while overflow and \
+                    (getTick(overflow[0][0]) >> topShift) == (currentTick >> topShift):
+                entry = heappop(overflow)
+                if entry[2] is None:
+                    self._removedCount -= 1
+                else:
+                    self._file(entry, getTick(entry[0]))
+        
+        for cascadeLevel in xrange(level-1, 0, -1):
+            slot = (currentTick >> (slotBits*cascadeLevel)) & self._slotMask
+            entries = self._wheels[cascadeLevel][slot]
+            if entries:
+                self._wheels[cascadeLevel][slot] = []
+                self._levelCounts[cascadeLevel] -= len(entries)
+                for entry in entries:
+                    if entry[2] is None:
+                        self._removedCount -= 1
+                    else:
+                        self._file(entry, getTick(entry[0]))
+    
+    def _getNextOccupiedTick(self):
+        """
+        Returns the next tick after the current one at which the wheel
+        has something to do, either expire a level 0 slot or cascade,
+        or None if the wheel is empty.
+        """
+        currentTick = self.currentTick
+        slotBits = self._slotBits
+        slotMask = self._slotMask
+        
+        if self._levelCounts[0]:
+            # level 0 slots behind the current position are always empty
+            slots = self._wheels[0]
+            for slot in xrange((currentTick & slotMask) + 1, slotMask + 1):
+                if slots[slot]:
+                    return (currentTick & ~slotMask) | slot
+        
+        # skip straight to the next slot boundary of the lowest
+        # non-empty wheel
+        for level in xrange(1, self._levelCount):
+            if self._levelCounts[level]:
+                return (currentTick | ((1 << (slotBits*level)) - 1)) + 1
+        
+        if self._overflow:
+            # jump directly to the top wheel rotation of the earliest
+            # overflowing entry
+            topShift = slotBits*self._levelCount
+            return max( (currentTick | ((1 << topShift) - 1)) + 1,
+                        (self._getTick(self._overflow[0][0]) >> topShift) << topShift )
+        
+        return None
+    
+    def _expire(self, entries, eventList):
+        """
+        Appends the events of 'entries' to eventList in the order they
+        should be executed, skipping cancelled entries.
+        """
+        entries.sort()
+        appendToEventList = eventList.append
+        takeEvent = self._takeEvent
+        for entry in entries:
+            event = takeEvent(entry)
+            if event is not None:
+                appendToEventList(event)
+
+    def getNextEvents(self, currentTime=None):
+        """
+        Returns the events which have yet to be executed and occur before
+        currentTime.
+        """
+        if currentTime is None: currentTime = Timing.mostAccurateTime()
+        
+        eventList = []
+        targetTick = self._getTick(currentTime)
+        slots = self._wheels[0]
+        slotMask = self._slotMask
+        
+        while self.currentTick < targetTick and \
+                (self._eventCount or self._removedCount):
+            
+            slot = self.currentTick & slotMask
+            entries = slots[slot]
+            if entries:
+                slots[slot] = []
+                self._levelCounts[0] -= len(entries)
+                self._expire(entries, eventList)
+            
+            nextTick = self._getNextOccupiedTick()
+            if nextTick is None or nextTick > targetTick:
+                nextTick = targetTick
+            
+            self.currentTick = nextTick
+            if not nextTick & slotMask:
+                self._cascade()
+        
+        if self.currentTick < targetTick:
+            # nothing is left on the wheel, so there is nothing to cascade
+            self.currentTick = targetTick
+        
+        # the current slot may still hold events later in this tick
+        slot = self.currentTick & slotMask
+        entries = slots[slot]
+        if entries:
+            due = [entry for entry in entries if entry[0] <= currentTime]
+            if due:
+                slots[slot] = [entry for entry in entries
+                               if entry[0] > currentTime]
+                self._levelCounts[0] -= len(due)
+                self._expire(due, eventList)
+        
+        return eventList
+    
+    def compact(self):
+        """
+        Removes the entries of cancelled events from the wheels.
+        """
+        for level, slots in enumerate(self._wheels):
+            for slot, entries in enumerate(slots):
+                if entries:
+                    slots[slot] = [entry for entry in entries
+                                   if entry[2] is not None]
+            self._levelCounts[level] = sum(len(entries) for entries in slots)
+        
+        self._overflow = [entry for entry in self._overflow
+                          if entry[2] is not None]
+        heapify(self._overflow)
+        self._removedCount = 0
+    
+    def _findNextEntry(self):
+        """
+        Returns (level, entryList, index) for the earliest pending entry
+        on the wheel, where level is None for the overflow heap, or
+        (None, None, None) if the wheel is empty.
+        """
+        if not self._eventCount:
+            return None, None, None
+        
+        currentTick = self.currentTick
+        slotBits = self._slotBits
+        slotMask = self._slotMask
+        
+        for level in xrange(self._levelCount):
+            if not self._levelCounts[level]:
+                continue
+            slots = self._wheels[level]
+            # slots behind the current position are always empty
+            for slot in xrange((currentTick >> (slotBits*level)) & slotMask,
+                               slotMask + 1):
+                index = _getEarliestIndex(slots[slot])
+                if index is not None:
+                    return level, slots[slot], index
+        
+        overflow = self._overflow
+        while overflow[0][2] is None:
+            heappop(overflow)
+            self._removedCount -= 1
+        return None, overflow, 0
+    
+    def popNextEvent(self):
+        """
+        Returns the newest event while removing it (if an event exists)
+        """
+        level, entries, index = self._findNextEntry()
+        if entries is None:
+            return None
+        
+        if level is None:
+            entry = heappop(entries)
+        else:
+            entry = entries.pop(index)
+            self._levelCounts[level] -= 1
+        
+        return self._takeEvent(entry)
+    
+    def getNextEvent(self):
+        """
+        Returns the newest event, leaving it on the queue (if an event exists)
+        """
+        level, entries, index = self._findNextEntry()
+        if entries is None:
+            return None
+        return entries[index][2]
+    
+    def getEventIterator(self):
+        """
+        Returns an iterator object for all of the events on the queue,
+        in the order they will be executed
+        """
+        entries = [entry for entry in self._overflow if entry[2] is not None]
+        for slots in self._wheels:
+            for slotEntries in slots:
+                entries.extend(entry for entry in slotEntries
+                               if entry[2] is not None)
+        entries.sort()
+        return iter([entry[2] for entry in entries])
+
+class SkipListEventQueue(CancellableQueue):
+    """
+    An event queue kept in an IndexableSkipList, for tools which inspect
+    the queue as well as execute it.  Adding, cancelling and executing
+    events, finding the k-th next event and finding the first event of a
+    time range all take O(log n), and the event count is kept up to date
+    in O(1).  Cancelled events are removed at once rather than lazily.
+    
+    Events which are already due when they are added are executed on the
+    next call to getNextEvents.
+    """
+    
+    def __init__(self, startTime = None):
+        
+        CancellableQueue.__init__(self)
+        
+        self._list = IndexableSkipList()
+    
+    def _fileEntry(self, entry):
+        self._list.insert(entry)
+    
+    def cancelEvent(self, handle):
+        """
+        Removes the event belonging to 'handle' from the queue.  Returns
+        True if the event was still pending.
+        """
+        entry = handle._entry
+        if entry[2] is None:
+            return False
+        
+        self._list.remove(entry)
+        entry[2] = None
+        self._eventCount -= 1
+        return True
+    
+    def compact(self):
+        """
+        Does nothing, as cancelled events are removed immediately.
+        """
+        pass
+    
+    def getNextEvents(self, currentTime=None):
+        """
+        Returns the events which have yet to be executed and occur before
+        currentTime.
+        """
+        if currentTime is None: currentTime = Timing.mostAccurateTime()
+        
+        events = []
+        appendToEvents = events.append
+        skipList = self._list
+        takeEvent = self._takeEvent
+        while skipList and skipList.first()[0] <= currentTime:
+            appendToEvents(takeEvent(skipList.popFirst()))
+        return events
+    
+    def popNextEvent(self):
+        """
+        Returns the newest event while removing it (if an event exists)
+        """
+        if self._list:
+            return self._takeEvent(self._list.popFirst())
+        return None
+    
+    def getNextEvent(self):
+        """
+        Returns the newest event, leaving it on the queue (if an event exists)
+        """
+        if self._list:
+            return self._list.first()[2]
+        return None
+    
+    def getEventAtIndex(self,index):
+        """
+        Returns the event at the given index, if it exists.  Index 0 is
+        the next event to be executed.
+        """
+        return self._list[index][2]
+    
+    def removeEventAtIndex(self,index):
+        """
+        Destroys the event at index, returning nothing
+        """
+        self._takeEvent(self._list.pop(index))
+    
+    def getIndexOfTime(self, eventTime):
+        """
+        Returns the index of the first event at or after 'eventTime',
+        which is also the number of events before it.
+        """
+        return self._list.bisectLeft([eventTime])
+    
+    def getEventIterator(self):
+        """
+        Returns an iterator object for all of the events on the queue,
+        in the order they will be executed
+        """
+        return (entry[2] for entry in self._list)
+    
+    def getEventsBetween(self, startTime, endTime):
+        """
+        Returns an iterator over the events with startTime <= time <=
+        endTime, in the order they will be executed.
+        """
+        for entry in self._list.iterFrom([startTime]):
+            if entry[0] > endTime:
+                break
+            yield entry[2]
 
-        #Loop through the top events in the queue, such that we have the next n
-        #events until a certain timestamp, where n is <= the max thread/proc
-        #count allocated for the event module
+def _getEarliestIndex(entries):
+    """
+    Returns the index of the earliest pending entry in the list
+    'entries', or None if there is none.
+    """
+    earliest = None
+    for index, entry in enumerate(entries):
+        if entry[2] is not None and \
+                (earliest is None or entry < entries[earliest]):
+            earliest = index
+    return earliest
 
-        #For each of these n events, assign the event to an executor that exists
-        #or make a new one (this way, multiple events can be executed at once)
+import os, errno, select
+from threading import Timer
+from collections import deque
 
-        pass
+if os.name == 'posix':
+    import fcntl
 
-class AbstractQueue:
-    def __init__(self):
+class ShardedEventQueue(AbstractQueue):
+    """
+    An event queue for several producer threads and a single consumer
+    thread.  Every producer thread appends to a buffer of its own (a
+    deque, whose append is atomic), so adding events never waits on a
+    lock.  getNextEvents, which must only be called from the consumer
+    thread, empties every buffer onto the consumer's private heap in one
+    pass and then pops the events which are due.
+    
+    Events which are already due when they are added are executed on the
+    next call to getNextEvents.
+    """
+    
+    # producers may add events from any thread without further locking
+    isThreadSafe = True
+    
+    def __init__(self, startTime = None):
+        
+        self._local = threading.local()
+        # (thread, buffer) for every producer thread
+        self._buffers = []
+        # only taken the first time a thread adds an event
+        self._buffersLock = threading.Lock()
+        # count.next is atomic under the GIL
+        self._nextSequence = itertools.count().next
+        
+        self._heap = HeapSortList()
+    
+    def _getBuffer(self):
         """
-        Sets up the event queue using a currently undefined structure
-        (possibly a mix of a dictionary and an array????)
+        Returns the calling thread's buffer, creating it if necessary.
         """
-        pass
-
+        try:
+            return self._local.buffer
+        except AttributeError:
+            buffer = self._local.buffer = deque()
+            self._buffersLock.acquire()
+            try:
+                self._buffers.append((threading.currentThread(), buffer))
+            finally:
+                self._buffersLock.release()
+            return buffer
+    
     def addEvent(self,event):
         """
-        Adds 'event' chronologically to the queue
+        Adds 'event' to the calling thread's buffer
         """
-        pass
-
+        self._getBuffer().append(
+            EventRecord((event.getTime(), self._nextSequence(), event)))
+        return True
+    
+    def addEvents(self,events):
+        """
+        Adds every event in the iterable 'events' to the calling thread's
+        buffer at once.  Returns a list with True for each event.
+        """
+        nextSequence = self._nextSequence
+        records = [EventRecord((event.getTime(), nextSequence(), event))
+                   for event in events]
+        self._getBuffer().extend(records)
+        return [True]*len(records)
+    
+    def _collect(self):
+        """
+        Moves the records from every producer's buffer onto the heap, and
+        forgets the buffers of producer threads which have finished.
+        """
+        self._buffersLock.acquire()
+        try:
+            buffers = list(self._buffers)
+        finally:
+            self._buffersLock.release()
+        
+        records = []
+        appendToRecords = records.append
+        finished = []
+        
+        for thread, buffer in buffers:
+            popleft = buffer.popleft
+            for i in xrange(len(buffer)):
+                appendToRecords(popleft())
+            if not thread.isAlive() and not buffer:
+                finished.append((thread, buffer))
+        
+        if finished:
+            self._buffersLock.acquire()
+            try:
+                for producer in finished:
+                    self._buffers.remove(producer)
+            finally:
+                self._buffersLock.release()
+        
+        if records:
+            self._heap.extend(records)
+    
+    def getNextEvents(self, currentTime=None):
+        """
+        Returns the events which have yet to be executed and occur before
+        currentTime.
+        """
+        if currentTime is None: currentTime = Timing.mostAccurateTime()
+        
+        self._collect()
+        
+        events = []
+        appendToEvents = events.append
+        heap = self._heap
+        while heap and heap.peek()[0] <= currentTime:
+            appendToEvents(heap.pop()[2])
+        return events
+    
     def popNextEvent(self):
         """
         Returns the newest event while removing it (if an event exists)
         """
-        pass
-
+        self._collect()
+        if self._heap:
+            return self._heap.pop()[2]
+        return None
+    
     def getNextEvent(self):
         """
         Returns the newest event, leaving it on the queue (if an event exists)
         """
-        pass
-
+        self._collect()
+        if self._heap:
+            return self._heap.peek()[2]
+        return None
+    
     def getEventCount(self):
         """
-        Returns the amount of events on the queue
+        Returns the amount of events on the queue, including those still
+        waiting in the producers' buffers
         """
-        # (Dev Note: remember, direct object access by 
-        # an external system is BAD for extensibility and modular design)
-        pass
-
-    def getEventAtIndex(self,index):
+        return len(self._heap) + sum(len(buffer) for thread, buffer in self._buffers)
+    
+    def getEventIterator(self):
         """
-        Returns the event at the given index, if it exists.
+        Returns an iterator object for all of the events on the queue,
+        in the order they will be executed
         """
-        pass
+        self._collect()
+        return iter([record[2] for record in sorted(self._heap)])
 
-    def removeEventAtIndex(self,index):
+
+class _Waker:
+    """
+    Lets one thread sleep until a timeout runs out or another thread
+    wakes it.  On POSIX systems this is a pipe watched with select,
+    which sleeps in the kernel and wakes immediately.  Elsewhere, a
+    threading.Event is used instead.
+    """
+    
+    def __init__(self):
+        
+        if os.name == 'posix':
+            self._readFD, self._writeFD = os.pipe()
+            for fd in (self._readFD, self._writeFD):
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._event = None
+        else:
+            self._event = threading.Event()
+    
+    def clear(self):
         """
-        Destroys the event at index, returning nothing
+        Forgets any wake up which has not been waited for.
         """
-        pass
-
-    def getEventIterator(self):
+        if self._event is not None:
+            self._event.clear()
+            return
+        try:
+            while os.read(self._readFD, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+    
+    def wait(self, timeout):
         """
-        Returns an iterator object for all of the events on the queue
+        Sleeps for up to 'timeout' seconds (forever if None) or until
+        wake is called.
         """
-        pass
-
-class Executor: #inherits from a thread/process class like Allen Downey's, but
-                # with more intelligence about its own existence.
-    # It should be some kind of daemon that does not interrupt
-    # standard execution flow
+        if self._event is not None:
+            self._event.wait(timeout)
+            return
+        try:
+            select.select([self._readFD], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+    
+    def wake(self):
+        
+        if self._event is not None:
+            self._event.set()
+            return
+        try:
+            os.write(self._writeFD, 'x')
+        except OSError, e:
+            # the pipe is full, so the waiter is woken already
+            if e.errno != errno.EAGAIN:
+                raise
+    
+    def __del__(self):
+        
+        if self._event is None:
+            os.close(self._readFD)
+            os.close(self._writeFD)
 
-    #Executors must die if they have no event for a certain amount of time
-    def __init__(self):
+class _NoLock:
+    """Stands in for the lock of queues which are already thread safe."""
+    
+    def acquire(self):
+        pass
+    
+    def release(self):
         pass
 
-import Queue, Timing
-
-from heapq import heappush, heappop
-class HeapSortList:
+class WaitableQueue:
+    """
+    Wraps an event queue so that the consumer can sleep until events are
+    due instead of calling getNextEvents in a loop.  waitForNextEvents
+    sleeps until the earliest event on the queue is due, and is woken
+    early when another thread adds an event which is due sooner.  No
+    thread is started per event.
     
-    def __init__(self):
+    The wrapped queue must implement getNextEvent.  Calls to the queue
+    are serialized with a lock, unless the queue has an 'isThreadSafe'
+    attribute which is True.  Every other attribute is passed through to
+    the wrapped queue.
+    """
+    
+    def __init__(self, queue):
         
-        self._list = []
+        self.queue = queue
+        if getattr(queue, 'isThreadSafe', False):
+            self._lock = _NoLock()
+        else:
+            self._lock = threading.Lock()
+        
+        self._waker = _Waker()
+        # the time the consumer is sleeping until, or None if it is awake
+        self._waitDeadline = None
     
-    def append(self, item):
-        heappush(self._list, item)
+    def _wakeFor(self, eventTime):
+        """
+        Wakes the consumer if it is sleeping past 'eventTime'.
+        """
+        waitDeadline = self._waitDeadline
+        if waitDeadline is not None and eventTime < waitDeadline:
+            self._waker.wake()
     
-    def pop(self):
-        return heappop(self._list)
+    def addEvent(self,event):
+        """
+        Adds 'event' to the queue, waking the consumer if the event is
+        due before it would have woken up.
+        """
+        self._lock.acquire()
+        try:
+            result = self.queue.addEvent(event)
+        finally:
+            self._lock.release()
+        self._wakeFor(event.getTime())
+        return result
+    
+    def addEvents(self,events):
+        """
+        Adds every event in the iterable 'events' to the queue at once.
+        """
+        events = list(events)
+        if not events:
+            return []
+        self._lock.acquire()
+        try:
+            result = self.queue.addEvents(events)
+        finally:
+            self._lock.release()
+        self._wakeFor(min(event.getTime() for event in events))
+        return result
+    
+    def getNextEvents(self, currentTime=None):
+        """
+        Returns the events which have yet to be executed and occur before
+        currentTime.
+        """
+        self._lock.acquire()
+        try:
+            return self.queue.getNextEvents(currentTime)
+        finally:
+            self._lock.release()
+    
+    def waitForNextEvents(self, timeout=None):
+        """
+        Sleeps until at least one event is due and returns the events
+        which are due.  Returns an empty list if no event came due within
+        'timeout' seconds (never, if timeout is None).  With a virtual
+        clock, the clock is advanced to the deadline instead.
+        """
+        clock = Timing.mostAccurateTime
+        if timeout is not None:
+            endTime = clock() + timeout
         
-    def __len__(self):
-        return len(self._list)
+        while True:
+            # announce the wait before looking at the queue, so that an
+            # event added after the look always wakes the consumer
+            self._waker.clear()
+            self._waitDeadline = float('inf')
+            
+            self._lock.acquire()
+            try:
+                now = clock()
+                events = self.queue.getNextEvents(now)
+                nextEvent = self.queue.getNextEvent()
+            finally:
+                self._lock.release()
+            
+            if events:
+                self._waitDeadline = None
+                return events
+            
+            if nextEvent is None:
+                waitDeadline = float('inf')
+            else:
+                waitDeadline = nextEvent.getTime()
+            if timeout is not None:
+                if now >= endTime:
+                    self._waitDeadline = None
+                    return events
+                waitDeadline = min(waitDeadline, endTime)
+            self._waitDeadline = waitDeadline
+            
+            timeSource = Timing.getClock()
+            if timeSource.isVirtual and waitDeadline != float('inf'):
+                # nothing can happen before the deadline, so skip to it
+                timeSource.advanceTo(waitDeadline)
+            elif waitDeadline == float('inf'):
+                self._waker.wait(None)
+            else:
+                self._waker.wait(max(waitDeadline - now, 0))
+    
+    def __getattr__(self, name):
+        
+        return getattr(self.queue, name)
 
-from threading import Timer
+# lanes of a LanedEventQueue created with the default lane budgets
+CRITICAL_LANE, NORMAL_LANE, COSMETIC_LANE = 0, 1, 2
+
+class LanedEventQueue(AbstractQueue):
+    """
+    An event queue with priority lanes, each of which is a separate
+    heap.  getNextEvents merges the lanes by time window first and lane
+    second: events whose times fall in the same 'window' seconds are
+    returned highest priority lane first, so a critical event due a
+    moment after a cosmetic one still runs before it.
+    
+    Each lane may have a budget, the most events it executes per call to
+    getNextEvents.  Events beyond a lane's budget wait for the next call,
+    so when a tick is overloaded the low priority lanes absorb the delay
+    and the critical lanes keep their latency.
+    
+    'laneBudgets' lists the budget of every lane, highest priority
+    first, with None for no limit.  Events are placed in the lane their
+    getLane method returns, or in 'defaultLane'.  Events which are
+    already due when they are added are executed on the next call to
+    getNextEvents.
+    """
+    
+    def __init__(self, startTime = None, laneBudgets = (None, None, None),
+                 window = 0.005, defaultLane = NORMAL_LANE):
+        
+        self.laneBudgets = list(laneBudgets)
+        self.window = window
+        self.defaultLane = defaultLane
+        
+        self._lanes = [HeapSortList() for budget in self.laneBudgets]
+        self._sequence = itertools.count()
+    
+    def _getLane(self, event):
+        
+        lane = event.getLane()
+        if lane is None:
+            lane = self.defaultLane
+        return self._lanes[lane]
+    
+    def addEvent(self,event):
+        """
+        Adds 'event' chronologically to its lane
+        """
+        self._getLane(event).append(
+            EventRecord((event.getTime(), next(self._sequence), event)))
+        return True
+    
+    def addEvents(self,events):
+        """
+        Adds every event in the iterable 'events' to the queue, with a
+        single batch insert per lane.
+        """
+        recordsByLane = {}
+        nextSequence = self._sequence.next
+        count = 0
+        for event in events:
+            recordsByLane.setdefault(id(self._getLane(event)), []).append(
+                EventRecord((event.getTime(), nextSequence(), event)))
+            count += 1
+        for lane in self._lanes:
+            records = recordsByLane.get(id(lane))
+            if records:
+                lane.extend(records)
+        return [True]*count
+    
+    def getNextEvents(self, currentTime=None):
+        """
+        Returns the events which are due by currentTime, by time window
+        and then by lane, leaving the events over each lane's budget on
+        the queue.
+        """
+        if currentTime is None: currentTime = Timing.mostAccurateTime()
+        
+        events = []
+        appendToEvents = events.append
+        window = self.window
+        lanes = self._lanes
+        budgets = list(self.laneBudgets)
+        
+        while True:
+            # the earliest window in which a lane with budget left has
+            # a due event
+            earliestWindow = None
+            for lane, budget in itertools.izip(lanes, budgets):
+                if lane and budget != 0:
+                    eventTime = lane.peek()[0]
+                    if eventTime <= currentTime:
+                        laneWindow = int(eventTime / window)
+                        if earliestWindow is None or laneWindow < earliestWindow:
+                            earliestWindow = laneWindow
+            if earliestWindow is None:
+                break
+            
+            for index, lane in enumerate(lanes):
+                budget = budgets[index]
+                while budget != 0 and lane and lane.peek()[0] <= currentTime and \
+                        int(lane.peek()[0] / window) <= earliestWindow:
+                    appendToEvents(lane.pop()[2])
+                    if budget is not None:
+                        budget -= 1
+                budgets[index] = budget
+        
+        return events
+    
+    def popNextEvent(self):
+        """
+        Returns the newest event while removing it (if an event exists)
+        """
+        lane = self._getEarliestLane()
+        if lane is None:
+            return None
+        return lane.pop()[2]
+    
+    def getNextEvent(self):
+        """
+        Returns the newest event, leaving it on the queue (if an event exists)
+        """
+        lane = self._getEarliestLane()
+        if lane is None:
+            return None
+        return lane.peek()[2]
+    
+    def _getEarliestLane(self):
+        """
+        Returns the lane holding the earliest event, preferring higher
+        priority lanes within a time window, or None if all are empty.
+        """
+        earliest = None
+        for lane in self._lanes:
+            if lane:
+                laneWindow = int(lane.peek()[0] / self.window)
+                if earliest is None or laneWindow < earliest[0]:
+                    earliest = (laneWindow, lane)
+        if earliest is None:
+            return None
+        return earliest[1]
+    
+    def getEventCount(self):
+        """
+        Returns the amount of events on the queue
+        """
+        return sum(len(lane) for lane in self._lanes)
+    
+    def getLaneDepths(self):
+        """
+        Returns the number of events waiting in each lane.
+        """
+        return [len(lane) for lane in self._lanes]
+    
+    def getEventIterator(self):
+        """
+        Returns an iterator object for all of the events on the queue,
+        ignoring budgets
+        """
+        records = []
+        for priority, lane in enumerate(self._lanes):
+            records.extend((int(record[0] / self.window), priority, record)
+                           for record in lane)
+        records.sort()
+        return iter([record[2][2] for record in records])
 
 class EventQueue4:
     
@@ -159,23 +1876,63 @@ class EventQueue4:
         self.executedEvents = []
         
     def addEvent(self,event):
+        """
+        Starts a Timer for 'event'.  Returns False if the event is
+        already past.
+        """
         timeDelay = event.getTime()-Timing.mostAccurateTime()
         
         if timeDelay >= 0:
             Timer(timeDelay,self.executedEvents.append,[event]).start()
+            return True
+        return False
+    
+    def addEvents(self,events):
+        """
+        Adds a batch of events, starting a single Timer for all of the
+        events which share a timestamp.  Returns a list with the result
+        of addEvent for each event.
+        """
+        events = list(events)
+        eventsByTime = {}
+        for event in events:
+            eventsByTime.setdefault(event.getTime(), []).append(event)
+        
+        currentTime = Timing.mostAccurateTime()
+        for eventTime, timeEvents in eventsByTime.iteritems():
+            timeDelay = eventTime-currentTime
+            if timeDelay >= 0:
+                Timer(timeDelay,self.executedEvents.extend,[timeEvents]).start()
+        return [event.getTime() >= currentTime for event in events]
 
-class EventQueue3:
+class EventQueue3(CancellableQueue):
     def __init__(self, startTime = None):
         """
         Sets up the event queue, which is a dictionary using keys
         of the form int(time.time).  The keys point to SortCacheLists,
         which store the events.
         """
+        CancellableQueue.__init__(self)
         
         self._queue = Queue.PriorityQueue()
         
-    def addEvent(self,event):
-        self._queue.put_nowait(event)
+    def _fileEntry(self, entry):
+        self._queue.put_nowait(entry)
+    
+    def _fileEntries(self, entries):
+        """
+        Files a batch of entries while holding the queue's lock only once.
+        """
+        queue = self._queue
+        queue.mutex.acquire()
+        try:
+            heap = queue.queue
+            heap.extend(entries)
+            heapify(heap)
+            queue.unfinished_tasks += len(entries)
+            queue.not_empty.notify(len(entries))
+        finally:
+            queue.mutex.release()
         
     def getNextEvents(self, currentTime=None):
         """
@@ -190,14 +1947,49 @@ class EventQueue3:
         
         while not queueEmptyFunc():
         
-            event = self._queue.get_nowait()
-            if event.getTime() <= currentTime:
-                events.append(event)
+            entry = self._queue.get_nowait()
+            if entry[0] <= currentTime:
+                event = self._takeEvent(entry)
+                if event is not None:
+                    events.append(event)
+            elif entry[2] is None:
+                self._removedCount -= 1
             else:
-                self._queue.put_nowait(event)
+                self._queue.put_nowait(entry)
                 break
                 
         return events
+    
+    def getNextEvent(self):
+        """
+        Returns the newest event, leaving it on the queue (if an event exists)
+        """
+        queue = self._queue
+        queue.mutex.acquire()
+        try:
+            heap = queue.queue
+            while heap and heap[0][2] is None:
+                heappop(heap)
+                queue.unfinished_tasks -= 1
+                self._removedCount -= 1
+            if heap:
+                return heap[0][2]
+            return None
+        finally:
+            queue.mutex.release()
+    
+    def compact(self):
+        """
+        Removes the entries of cancelled events from the queue.
+        """
+        queue = self._queue
+        queue.mutex.acquire()
+        try:
+            queue.queue = [entry for entry in queue.queue if entry[2] is not None]
+            heapify(queue.queue)
+            self._removedCount = 0
+        finally:
+            queue.mutex.release()
 
 class EventQueue2a:
     def __init__(self, startTime = None):
@@ -208,9 +2000,18 @@ class EventQueue2a:
         """
         
         self._list = list()
+        self._sequence = itertools.count()
         
     def addEvent(self,event):
-        self._list.append(event)
+        self._list.append(EventRecord((event.getTime(), next(self._sequence), event)))
+        return True
+        
+    def addEvents(self,events):
+        nextSequence = self._sequence.next
+        records = [EventRecord((event.getTime(), nextSequence(), event))
+                   for event in events]
+        self._list.extend(records)
+        return [True]*len(records)
         
     def getNextEvents(self, currentTime=None):
         """
@@ -223,8 +2024,8 @@ class EventQueue2a:
         appendToEvents = events.append
         self._list.sort()
         for it in xrange(len(self._list)):
-            if self._list[0].getTime() <= currentTime:
-                appendToEvents(self._list.pop(0))
+            if self._list[0][0] <= currentTime:
+                appendToEvents(self._list.pop(0)[2])
             else:
                 break
                 
@@ -239,9 +2040,18 @@ class EventQueue2:
         """
         
         self._list = SortCacheList()
+        self._sequence = itertools.count()
         
     def addEvent(self,event):
-        self._list.append(event)
+        self._list.append(EventRecord((event.getTime(), next(self._sequence), event)))
+        return True
+        
+    def addEvents(self,events):
+        nextSequence = self._sequence.next
+        records = [EventRecord((event.getTime(), nextSequence(), event))
+                   for event in events]
+        self._list.extend(records)
+        return [True]*len(records)
         
     def getNextEvents(self, currentTime=None):
         """
@@ -254,37 +2064,35 @@ class EventQueue2:
         appendToEvents = events.append
         self._list.sort()
         for it in xrange(len(self._list)):
-            if self._list[0].getTime() <= currentTime:
-                appendToEvents(self._list.pop(0))
+            if self._list[0][0] <= currentTime:
+                appendToEvents(self._list.pop(0)[2])
             else:
                 break
                 
         return events
 
-class EventQueue1:
+class EventQueue1(CancellableQueue):
     def __init__(self, startTime = None):
         """
         Sets up the event queue, which is a dictionary using keys
         of the form int(time.time).  The keys point to SortCacheLists,
         which store the events.
         """
+        CancellableQueue.__init__(self)
         
         self.queue = HeapSortList()
         
         if startTime is None: startTime = Timing.mostAccurateTime()
         self.lastTime = startTime
 
-    def addEvent(self,event):
-        """
-        Adds 'event' chronologically to the queue
-        """
-        eventTime = event.getTime()
-        if eventTime > self.lastTime:
-            self.queue.append(event)
-            return True
-        else:
-            print 'Warning: event missed.'
-            return False
+    def _isTimeAccepted(self, eventTime):
+        return eventTime > self.lastTime
+
+    def _fileEntry(self, entry):
+        self.queue.append(entry)
+
+    def _fileEntries(self, entries):
+        self.queue.extend(entries)
 
     def getNextEvents(self, currentTime=None):
         """
@@ -295,40 +2103,82 @@ class EventQueue1:
         
         events = []
         appendToEventList = events.append
+        takeEvent = self._takeEvent
         for it in xrange(len(self.queue)):
-            event = self.queue.pop()
-            if currentTime >= event.getTime():
-                appendToEventList(event)
+            entry = self.queue.pop()
+            if currentTime >= entry[0]:
+                event = takeEvent(entry)
+                if event is not None:
+                    appendToEventList(event)
+            elif entry[2] is None:
+                self._removedCount -= 1
             else:
                 # add event back to queue
-                self.queue.append(event)
+                self.queue.append(entry)
                 break
         return events
+    
+    def getNextEvent(self):
+        """
+        Returns the newest event, leaving it on the queue (if an event exists)
+        """
+        queue = self.queue
+        while queue and queue.peek()[2] is None:
+            queue.pop()
+            self._removedCount -= 1
+        if queue:
+            return queue.peek()[2]
+        return None
+    
+    def compact(self):
+        """
+        Removes the entries of cancelled events from the queue.
+        """
+        self.queue.retain(lambda entry: entry[2] is not None)
+        self._removedCount = 0
         
-class EventQueue:
+class EventQueue(CancellableQueue):
     def __init__(self, startTime = None):
         """
         Sets up the event queue, which is a dictionary using keys
         of the form int(time.time).  The keys point to SortCacheLists,
-        which store the events.
+        which store the event entries.
         """
+        CancellableQueue.__init__(self)
         
         self.queuedEvents = {}
+        # a heap of the keys of queuedEvents, which may still hold keys
+        # whose lists have been deleted
+        self._timeIndices = []
         
         if startTime is None: startTime = Timing.mostAccurateTime()
         self.lastTime = startTime
 
-    def addEvent(self,event):
+    def _isTimeAccepted(self, eventTime):
+        return eventTime > self.lastTime
+
+    def _getEntries(self, timeIndex):
         """
-        Adds 'event' chronologically to the queue
+        Returns the list of entries for the second 'timeIndex', creating
+        it if necessary.
         """
-        eventTime = event.getTime()
-        if eventTime > self.lastTime:
-            self.queuedEvents.setdefault( int(eventTime), SortCacheList() ).append(event)
-            return True
-        else:
-            print 'Warning: event missed.'
-            return False
+        entries = self.queuedEvents.get(timeIndex)
+        if entries is None:
+            entries = self.queuedEvents[timeIndex] = SortCacheList()
+            heappush(self._timeIndices, timeIndex)
+        return entries
+
+    def _fileEntry(self, entry):
+        self._getEntries( int(entry[0]) ).append(entry)
+
+    def _fileEntries(self, entries):
+        """
+        Files a batch of entries with one dictionary lookup per second.
+        """
+        entries.sort()
+        for timeIndex, timeIndexEntries in itertools.groupby(entries,
+                                                lambda entry: int(entry[0])):
+            self._getEntries( timeIndex ).extend(timeIndexEntries)
 
     def getNextEvents(self, currentTime=None):
         """
@@ -339,46 +2189,85 @@ class EventQueue:
         
         eventList = []
         appendToEventList = eventList.append
+        takeEvent = self._takeEvent
         currentTimeIndex = int(currentTime)
         
         for timeIndex in xrange( int(self.lastTime), currentTimeIndex ):
             
-            timeIndexEvents = self.queuedEvents.get(timeIndex,None)
+            timeIndexEntries = self.queuedEvents.get(timeIndex,None)
             
-            if timeIndexEvents is not None:
+            if timeIndexEntries is not None:
                 
-                timeIndexEvents.sort()
+                timeIndexEntries.sort()
                 
-                for event in timeIndexEvents:
-                    appendToEventList(event)
+                for entry in timeIndexEntries:
+                    event = takeEvent(entry)
+                    if event is not None:
+                        appendToEventList(event)
                 
                 del self.queuedEvents[timeIndex]
             
-        currentEvents = self.queuedEvents.get(currentTimeIndex,None)
+        currentEntries = self.queuedEvents.get(currentTimeIndex,None)
         
-        if currentEvents is not None:
+        if currentEntries is not None:
             
-            currentEvents.sort()
+            currentEntries.sort()
             
-            for i in xrange(len(currentEvents)):
+            for i in xrange(len(currentEntries)):
                 
-                event = currentEvents[0]
-                if event.time <= currentTime:
-                    appendToEventList(currentEvents.pop(0))
+                entry = currentEntries[0]
+                if entry[0] <= currentTime:
+                    event = takeEvent(currentEntries.pop(0))
+                    if event is not None:
+                        appendToEventList(event)
                 else:
                     break
         
+        # forget the keys of the seconds deleted above
+        timeIndices = self._timeIndices
+        while timeIndices and timeIndices[0] < currentTimeIndex:
+            heappop(timeIndices)
+        
         self.lastTime = currentTime
         
         return eventList
 
-    def getEventCount(self):
+    def getNextEvent(self):
         """
-        Returns the amount of events on the queue
+        Returns the newest event, leaving it on the queue (if an event exists)
         """
-        # (Dev Note: remember, direct object access by 
-        # an external system is BAD for extensibility and modular design)
-        return reduce(lambda x,y: x+y, [len(t) for t in self.queuedEvents.itervalues()])
+        queuedEvents = self.queuedEvents
+        timeIndices = self._timeIndices
+        
+        while timeIndices:
+            timeIndex = timeIndices[0]
+            entries = queuedEvents.get(timeIndex)
+            if entries is not None:
+                entries.sort()
+                for index, entry in enumerate(entries):
+                    if entry[2] is not None:
+                        # drop the cancelled entries in front of it
+                        if index:
+                            del entries[:index]
+                            self._removedCount -= index
+                        return entry[2]
+                # every event of the second was cancelled
+                self._removedCount -= len(entries)
+                del queuedEvents[timeIndex]
+            heappop(timeIndices)
+        return None
+    
+    def compact(self):
+        """
+        Removes the entries of cancelled events from the queue.
+        """
+        for timeIndex, entries in self.queuedEvents.items():
+            entries[:] = [entry for entry in entries if entry[2] is not None]
+            if not entries:
+                del self.queuedEvents[timeIndex]
+        self._timeIndices = list(self.queuedEvents)
+        heapify(self._timeIndices)
+        self._removedCount = 0
 
 class SortedList(list):
     
@@ -421,29 +2310,32 @@ class SortCacheList(list):
 
         self.isSorted = False
         super(SortCacheList, self).append(item)
+    
+    def extend(self, items):
+
+        self.isSorted = False
+        super(SortCacheList, self).extend(items)
 
-class TestEvent:
+class TestEvent(TimedEvent):
+    
+    __slots__ = ('data',)
     
     def __init__(self, data=None, delay=0):
         
-        self.time = Timing.mostAccurateTime()+delay
+        TimedEvent.__init__(self)
+        self.time += delay
         self.data = data
-    
-    def getTime(self):
-        
-        return self.time
-        
-    def __cmp__(self, other):
-
-        return self.time > other.time
 
 if __name__ == '__main__':
     
     import random
     
+    # run in simulated time, so the demo does not take 5.25 s
+    Timing.setClock(Timing.VirtualClock(Timing.getClock().now()))
+    
     startTime = currentTime = Timing.mostAccurateTime()
     delay = 5.250
-    eq=EventQueue2a(startTime)
+    eq=WaitableQueue(EventQueue1(startTime))
     numEv=500
     # add 500 events to the queue to execute after "delay" seconds.
     for t in xrange(numEv):   
@@ -451,6 +2343,24 @@ if __name__ == '__main__':
     
     numEvents = 0
     while numEvents < numEv:
+        # sleeps until the events are due instead of spinning
+        numEvents+=len(eq.waitForNextEvents())
         currentTime = Timing.mostAccurateTime()
-        numEvents+=len(eq.getNextEvents(currentTime))
     print 'Elapsed time: %.6f'%(currentTime-startTime)
+    
+    # a rescheduled event coalesces in the window it was moved to
+    class KeyedTestEvent(TestEvent):
+        
+        __slots__ = ()
+        
+        def getCoalescingKey(self):
+            return self.data
+    
+    eq=EventQueue1(0.0)
+    eq.setCoalescingWindow(1.0)
+    first, second = KeyedTestEvent('k'), KeyedTestEvent('k')
+    first.time, second.time = 5.2, 5.6
+    eq.rescheduleEvent(eq.addEvent(first), 8.5)
+    eq.addEvent(second)
+    assert [event.getTime() for event in eq.getNextEvents(10.0)] == [5.6, 8.5]
+    print 'Coalescing after rescheduling: ok'
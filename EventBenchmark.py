@@ -0,0 +1,393 @@
+"""
+Event Queue Benchmark
+--------------------
+Summary: Compares the event queue variants in Event.py and eventModule.py.
+
+Every queue is filled with the same set of events, drawn from one of
+several time distributions, and then drained by a simulated game loop
+which ticks at a fixed step.  Idle stretches with no due events are
+skipped over, so far-future events do not make the benchmark run in real
+time.  For each queue and distribution the benchmark records:
+
+    insert throughput   - events added per second, one at a time or,
+                          with --bulk, in a single addEvents call
+    drain throughput    - events returned by getNextEvents per second
+    lateness            - p50/p99/max of (time returned - event time)
+    memory              - bytes per pending event, with and without the
+                          events themselves
+
+The results are written as JSON so that runs from different releases can
+be compared.  EventQueue4 starts a real Timer thread per event, so it is
+only run with a small number of events and in real time, and it is
+skipped for far-future events.
+
+Usage:
+    python EventBenchmark.py -n 20000 -o eventBenchmark.json
+"""
+
+import sys, gc, math, random, platform, json, time, types
+from collections import deque
+from optparse import OptionParser
+
+import Timing
+import Event, eventModule
+
+try:
+    import ArrayEventQueue
+except ImportError:
+    # numpy is not installed
+    ArrayEventQueue = None
+
+#########################
+#    Queue Variants     #
+#########################
+
+# (name, factory, module the events are created from)
+# A factory takes the simulated start time and returns an empty queue.
+QUEUE_VARIANTS = [
+    ('Event.EventQueue', Event.EventQueue, Event),
+    ('Event.EventQueue1', Event.EventQueue1, Event),
+    ('Event.EventQueue2', Event.EventQueue2, Event),
+    ('Event.EventQueue2a', Event.EventQueue2a, Event),
+    ('Event.EventQueue3', Event.EventQueue3, Event),
+    ('Event.EventQueue4', Event.EventQueue4, Event),
+    ('Event.TimingWheelEventQueue', Event.TimingWheelEventQueue, Event),
+    ('Event.ShardedEventQueue', Event.ShardedEventQueue, Event),
+    ('Event.SkipListEventQueue', Event.SkipListEventQueue, Event),
+    ('eventModule.EventQueue', eventModule.EventQueue, eventModule),
+]
+
+if ArrayEventQueue is not None:
+    QUEUE_VARIANTS.append(('ArrayEventQueue.ArrayEventQueue',
+                           ArrayEventQueue.ArrayEventQueue, Event))
+
+# queues which execute events on their own threads in real time
+REAL_TIME_VARIANTS = ('Event.EventQueue4',)
+
+#########################
+#    Distributions      #
+#########################
+
+def uniformTimes(rand, count, span):
+    """Events spread evenly over the span."""
+    return [rand.uniform(0, span) for i in xrange(count)]
+
+def burstyTimes(rand, count, span, burstCount=20, burstWidth=0.002):
+    """Events clumped into a few short bursts, as after a big fight."""
+    centers = [rand.uniform(0, span) for i in xrange(burstCount)]
+    return [rand.choice(centers) + rand.expovariate(1.0/burstWidth)
+            for i in xrange(count)]
+
+def sameTimes(rand, count, span):
+    """Every event has the same timestamp."""
+    return [span/2.0]*count
+
+def farFutureTimes(rand, count, span, distance=3600.0):
+    """Events scheduled an hour or more into the future."""
+    return [distance + rand.uniform(0, span) for i in xrange(count)]
+
+def pastDueTimes(rand, count, span):
+    """Events which were due before the queue was created."""
+    return [-rand.uniform(0, span) for i in xrange(count)]
+
+DISTRIBUTIONS = [
+    ('uniform', uniformTimes),
+    ('bursty', burstyTimes),
+    ('same', sameTimes),
+    ('farFuture', farFutureTimes),
+    ('pastDue', pastDueTimes),
+]
+
+#########################
+#    Measurement        #
+#########################
+
+class _NullOutput:
+    """Swallows the warnings some queues print for every missed event."""
+    def write(self, text):
+        pass
+
+def percentile(sortedValues, fraction):
+    """
+    Returns the nearest-rank percentile of an already sorted list.
+    """
+    if not sortedValues:
+        return None
+    rank = int(math.ceil(fraction*len(sortedValues))) - 1
+    return sortedValues[min(max(rank, 0), len(sortedValues)-1)]
+
+_UNSIZED_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType,
+                  types.BuiltinFunctionType, types.MethodType)
+
+def deepSizeOf(obj, excluded=()):
+    """
+    Returns the approximate number of bytes used by obj and everything
+    it references.  Objects in 'excluded' (and everything only reachable
+    through them) are not counted.
+    """
+    seen = set(id(o) for o in excluded)
+    stack = [obj]
+    total = 0
+
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, _UNSIZED_TYPES):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+
+        if isinstance(o, dict):
+            stack.extend(o.iterkeys())
+            stack.extend(o.itervalues())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend(o)
+        elif getattr(getattr(o, 'dtype', None), 'hasobject', False):
+            # numpy arrays of objects
+            stack.extend(o.flat)
+
+        if hasattr(o, '__dict__'):
+            stack.append(o.__dict__)
+        for cls in getattr(type(o), '__mro__', ()):
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(o, slot):
+                    stack.append(getattr(o, slot))
+
+    return total
+
+def makeEvents(module, times):
+    """
+    Returns a TestEvent from 'module' for every time in 'times'.
+    """
+    events = []
+    for eventTime in times:
+        event = module.TestEvent()
+        event.time = eventTime
+        events.append(event)
+    return events
+
+def summarize(name, distribution, events, accepted, insertTime, drainTime,
+              lateness, memory, overhead):
+
+    lateness.sort()
+    return {
+        'queue': name,
+        'distribution': distribution,
+        'events': len(events),
+        'accepted': accepted,
+        'delivered': len(lateness),
+        'insertSeconds': insertTime,
+        'insertPerSecond': len(events)/insertTime if insertTime else None,
+        'drainSeconds': drainTime,
+        'drainPerSecond': len(lateness)/drainTime if drainTime else None,
+        'latenessP50': percentile(lateness, 0.50),
+        'latenessP99': percentile(lateness, 0.99),
+        'latenessMax': lateness[-1] if lateness else None,
+        'bytesPerEvent': float(memory)/accepted if accepted else None,
+        'overheadBytesPerEvent': float(overhead)/accepted if accepted else None,
+    }
+
+def runSimulated(name, factory, module, distribution, relativeTimes, step,
+                 bulk=False):
+    """
+    Fills a queue and drains it with a simulated clock which advances by
+    'step' seconds per tick, plus however long getNextEvents itself took.
+    """
+    clock = Timing.mostAccurateTime
+    baseTime = 1000000.0
+    events = makeEvents(module, [baseTime + t for t in relativeTimes])
+
+    queue = factory(baseTime)
+    addEvent = queue.addEvent
+
+    stdout, sys.stdout = sys.stdout, _NullOutput()
+    try:
+        gc.disable()
+        startTime = clock()
+        if bulk and hasattr(queue, 'addEvents'):
+            added = queue.addEvents(events)
+        else:
+            added = [addEvent(event) for event in events]
+        insertTime = clock() - startTime
+        gc.enable()
+
+        # some queues return nothing at all, and never miss events
+        if added is None:
+            accepted = len(events)
+        else:
+            accepted = len([result for result in added if result is not False])
+
+        memory = deepSizeOf(queue)
+        overhead = deepSizeOf(queue, events)
+
+        # the accepted events in the order they should come out of the queue
+        dueTimes = sorted(event.time for event in events)[len(events)-accepted:]
+        lateness = []
+        drainTime = 0.0
+        now = baseTime
+        getNextEvents = queue.getNextEvents
+
+        while len(lateness) < accepted:
+            startTime = clock()
+            dueEvents = getNextEvents(now)
+            cost = clock() - startTime
+            drainTime += cost
+
+            returnedAt = now + cost
+            for event in dueEvents:
+                lateness.append(returnedAt - event.time)
+
+            if len(lateness) >= accepted:
+                break
+            if now > dueTimes[-1] + step and not dueEvents:
+                # the queue has lost events; don't wait for them forever
+                break
+
+            # skip ticks in which nothing would be due
+            now += max(step, cost)
+            nextDue = dueTimes[len(lateness)]
+            if nextDue > now:
+                now += math.ceil((nextDue - now)/step)*step
+    finally:
+        gc.enable()
+        sys.stdout = stdout
+
+    return summarize(name, distribution, events, accepted, insertTime,
+                     drainTime, lateness, memory, overhead)
+
+class _LatenessRecorder(list):
+    """
+    Stands in for EventQueue4.executedEvents and records how late each
+    event was when its Timer fired.
+    """
+    def __init__(self):
+        list.__init__(self)
+        self.lateness = []
+
+    def append(self, event):
+        self.lateness.append(Timing.mostAccurateTime() - event.time)
+        list.append(self, event)
+
+    def extend(self, events):
+        for event in events:
+            self.append(event)
+
+def runRealTime(name, factory, module, distribution, relativeTimes, timeout,
+                bulk=False):
+    """
+    Fills a queue which executes its own events and waits in real time
+    for them to be executed.
+    """
+    clock = Timing.mostAccurateTime
+    baseTime = clock() + 0.5
+    events = makeEvents(module, [baseTime + t for t in relativeTimes])
+
+    queue = factory(baseTime)
+    queue.executedEvents = recorder = _LatenessRecorder()
+
+    startTime = clock()
+    if bulk:
+        queue.addEvents(events)
+    else:
+        for event in events:
+            queue.addEvent(event)
+    insertTime = clock() - startTime
+
+    accepted = len([event for event in events if event.time >= startTime])
+    memory = overhead = 0
+
+    deadline = baseTime + max(relativeTimes) + timeout
+    while len(recorder) < accepted and clock() < deadline:
+        time.sleep(0.01)
+
+    return summarize(name, distribution, events, accepted, insertTime, 0.0,
+                     recorder.lateness, memory, overhead)
+
+#########################
+#    Driver             #
+#########################
+
+def runBenchmarks(queueNames=None, distributionNames=None, count=10000,
+                  span=10.0, step=0.001, seed=0, realTimeCount=200,
+                  bulk=False):
+    """
+    Runs every requested queue against every requested distribution and
+    returns a list of result dictionaries.
+    """
+    results = []
+
+    for distribution, generator in DISTRIBUTIONS:
+        if distributionNames and distribution not in distributionNames:
+            continue
+
+        for name, factory, module in QUEUE_VARIANTS:
+            if queueNames and name not in queueNames:
+                continue
+
+            # every queue sees exactly the same event times
+            rand = random.Random(seed)
+
+            if name in REAL_TIME_VARIANTS:
+                if distribution == 'farFuture':
+                    continue
+                times = generator(rand, min(count, realTimeCount), min(span, 2.0))
+                result = runRealTime(name, factory, module, distribution,
+                                     times, 1.0, bulk)
+            else:
+                times = generator(rand, count, span)
+                result = runSimulated(name, factory, module, distribution,
+                                      times, step, bulk)
+
+            results.append(result)
+            print '%-32s %-10s insert %10.0f/s  drain %10s/s  p99 late %s' % (
+                name, distribution, result['insertPerSecond'] or 0,
+                '%.0f' % result['drainPerSecond'] if result['drainPerSecond'] else '-',
+                '%.6f' % result['latenessP99'] if result['latenessP99'] is not None else '-')
+
+    return results
+
+def writeResults(path, results, options):
+    """
+    Writes the results, along with what they were measured on, to a JSON
+    file at 'path'.
+    """
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'options': options,
+        'results': results,
+    }
+    outputFile = open(path, 'w')
+    try:
+        json.dump(report, outputFile, indent=1, sort_keys=True)
+    finally:
+        outputFile.close()
+
+if __name__ == '__main__':
+
+    parser = OptionParser()
+    parser.add_option('-n', '--count', type='int', default=10000,
+                      help='number of events per run')
+    parser.add_option('-s', '--span', type='float', default=10.0,
+                      help='seconds the event times are spread over')
+    parser.add_option('--step', type='float', default=0.001,
+                      help='seconds per simulated drain tick')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('-q', '--queues', default='',
+                      help='comma separated queue names (default: all)')
+    parser.add_option('-d', '--distributions', default='',
+                      help='comma separated distributions (default: all)')
+    parser.add_option('-b', '--bulk', action='store_true', default=False,
+                      help='insert each batch with a single addEvents call')
+    parser.add_option('-o', '--output', default='eventBenchmark.json')
+
+    (options, args) = parser.parse_args()
+
+    queueNames = [n for n in options.queues.split(',') if n]
+    distributionNames = [n for n in options.distributions.split(',') if n]
+
+    results = runBenchmarks(queueNames, distributionNames, options.count,
+                            options.span, options.step, options.seed,
+                            bulk=options.bulk)
+    writeResults(options.output, results, vars(options))
+    print 'Wrote %d results to %s' % (len(results), options.output)
@@ -0,0 +1,255 @@
+"""
+Event Journal
+--------------------
+Summary: Records the events a queue returns so that they can be replayed.
+
+A JournaledQueue wraps any event queue and appends every event returned
+by getNextEvents to an EventJournal, so that a desync can be debugged by
+replaying the server's event stream instead of reproducing it live.
+
+The journal is a compact binary log.  After a short header, every event
+is stored as a fixed size record header followed by the pickled event:
+
+    tickTime    double  - the currentTime of the getNextEvents call
+    eventTime   double  - the time of the event
+    sequence    uint64  - numbers the events in the order they executed
+    length      uint32  - size of the pickled event in bytes
+
+Records are collected in memory and written in batches, so journaling a
+tick costs one write call at most.  The reader maps the file into memory
+and unpacks records in place.  ReplayQueue feeds the journal back through
+getNextEvents tick by tick, and replay() drives it as fast as possible,
+so an hour of server events replays in seconds.
+"""
+
+import os, struct, mmap, cPickle
+
+import Timing
+
+_MAGIC = 'JJEJ'
+_VERSION = 1
+_FILE_HEADER = struct.Struct('<4sI')
+_RECORD_HEADER = struct.Struct('<ddQI')
+
+class EventJournal:
+    """
+    Appends executed events to the journal file at 'path'.  Records are
+    buffered until at least 'bufferSize' bytes are waiting, or until
+    flush or close is called.
+    """
+
+    def __init__(self, path, bufferSize=65536):
+
+        self.path = path
+        self.bufferSize = bufferSize
+
+        self._file = open(path, 'ab')
+        self.sequence = 0
+        if os.path.getsize(path) < _FILE_HEADER.size:
+            # a new journal, or one whose header was never completely written
+            self._file.truncate(0)
+            self._file.write(_FILE_HEADER.pack(_MAGIC, _VERSION))
+        else:
+            # continue the sequence of an existing journal, and drop a
+            # record which was cut short, so that the new ones follow the
+            # last complete record
+            end = _FILE_HEADER.size
+            reader = EventJournalReader(path)
+            try:
+                for sequence, start, end in reader._records():
+                    self.sequence = sequence + 1
+            finally:
+                reader.close()
+            self._file.truncate(end)
+
+        self._buffer = []
+        self._bufferedBytes = 0
+
+    def record(self, events, tickTime):
+        """
+        Appends 'events', which were returned together by a call to
+        getNextEvents(tickTime), to the journal.
+        """
+        if not events:
+            return
+
+        appendToBuffer = self._buffer.append
+        packHeader = _RECORD_HEADER.pack
+        dumps = cPickle.dumps
+        sequence = self.sequence
+        size = 0
+
+        for event in events:
+            payload = dumps(event, 2)
+            header = packHeader(tickTime, event.getTime(), sequence, len(payload))
+            appendToBuffer(header)
+            appendToBuffer(payload)
+            size += len(header) + len(payload)
+            sequence += 1
+
+        self.sequence = sequence
+        self._bufferedBytes += size
+        if self._bufferedBytes >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every buffered record to the file.
+        """
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer = []
+            self._bufferedBytes = 0
+        self._file.flush()
+
+    def close(self):
+
+        self.flush()
+        self._file.close()
+
+class EventJournalReader:
+    """
+    Reads a journal written by EventJournal through a read-only memory
+    map.  Iterating over the reader yields (tickTime, eventTime, sequence,
+    event) for every record, in the order the events were executed.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        journalFile = open(path, 'rb')
+        try:
+            if os.fstat(journalFile.fileno()).st_size < _FILE_HEADER.size:
+                # nothing has been written yet, or the header is still
+                # buffered by the journal, so there are no records
+                self._map = ''
+                return
+            self._map = mmap.mmap(journalFile.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            journalFile.close()
+
+        magic, version = _FILE_HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            raise ValueError('%s is not an event journal' % path)
+        if version != _VERSION:
+            raise ValueError('unsupported event journal version %d' % version)
+
+    def __iter__(self):
+
+        data = self._map
+        unpackHeader = _RECORD_HEADER.unpack_from
+        loads = cPickle.loads
+
+        for sequence, start, end in self._records():
+            tickTime, eventTime = unpackHeader(data, start)[:2]
+            yield tickTime, eventTime, sequence, loads(data[start+_RECORD_HEADER.size:end])
+
+    def _records(self):
+        """
+        Yields (sequence, start, end) for every complete record, where
+        start and end are the offsets of the record in the file.
+        """
+        data = self._map
+        end = len(data)
+        offset = _FILE_HEADER.size
+        headerSize = _RECORD_HEADER.size
+        unpackHeader = _RECORD_HEADER.unpack_from
+
+        while offset + headerSize <= end:
+            sequence, length = unpackHeader(data, offset)[2:]
+            if offset + headerSize + length > end:
+                # the record was cut short while it was being written
+                break
+            yield sequence, offset, offset + headerSize + length
+            offset += headerSize + length
+
+    def close(self):
+
+        if self._map:
+            self._map.close()
+
+class JournaledQueue:
+    """
+    Wraps an event queue, recording every event returned by its
+    getNextEvents in 'journal'.  Every other attribute is passed through
+    to the wrapped queue.
+    """
+
+    def __init__(self, queue, journal):
+
+        self.queue = queue
+        self.journal = journal
+
+    def getNextEvents(self, currentTime=None):
+        """
+        Returns the events which have yet to be executed and occur before
+        currentTime.
+        """
+        if currentTime is None: currentTime = Timing.mostAccurateTime()
+
+        events = self.queue.getNextEvents(currentTime)
+        self.journal.record(events, currentTime)
+        return events
+
+    def __getattr__(self, name):
+
+        return getattr(self.queue, name)
+
+class ReplayQueue:
+    """
+    Returns the events of a journal from getNextEvents, grouped into the
+    same ticks, and in the same order, in which they were recorded.
+    """
+
+    def __init__(self, reader):
+
+        self._records = iter(reader)
+        self._nextRecord = next(self._records, None)
+
+    def getNextTickTime(self):
+        """
+        Returns the time of the next recorded tick, or None once the
+        journal has been replayed.
+        """
+        if self._nextRecord is None:
+            return None
+        return self._nextRecord[0]
+
+    def getNextEvents(self, currentTime=None):
+        """
+        Returns the recorded events of every tick up to currentTime.
+        """
+        if currentTime is None: currentTime = Timing.mostAccurateTime()
+
+        events = []
+        record = self._nextRecord
+        records = self._records
+        while record is not None and record[0] <= currentTime:
+            events.append(record[3])
+            record = next(records, None)
+        self._nextRecord = record
+        return events
+
+def replay(path, handler=None):
+    """
+    Replays the journal at 'path' as fast as possible, calling
+    handler(event) for every event (by default, the event's execute
+    method).  Returns the number of events replayed.
+    """
+    reader = EventJournalReader(path)
+    try:
+        queue = ReplayQueue(reader)
+        count = 0
+        tickTime = queue.getNextTickTime()
+        while tickTime is not None:
+            for event in queue.getNextEvents(tickTime):
+                if handler is None:
+                    event.execute()
+                else:
+                    handler(event)
+                count += 1
+            tickTime = queue.getNextTickTime()
+        return count
+    finally:
+        reader.close()
@@ -0,0 +1,171 @@
+"""
+Instrumentation
+--------------------
+Summary: Low overhead counters, gauges and latency histograms for the
+hot paths of the event queues, the simulator and the sockets.
+
+Instrumentation is off until enable() is called.  Every instrumented
+call site first checks the module level 'enabled' flag, so when it is
+off, the cost is a single attribute lookup.  When it is on, recording a
+value is a dictionary lookup and, for histograms, a bisect into a fixed
+list of bucket bounds; nothing is allocated per value.  Updates are not
+locked, so executors recording at the same moment may occasionally lose
+a count; the values are for monitoring, not for accounting.
+
+snapshot() returns the current values of every metric as plain
+dictionaries and lists, and writeSnapshot() saves them as JSON.
+
+Metric names are dotted paths.  The ones recorded by this package are:
+
+    manager.queueDepth                  gauge
+    manager.lateness                    histogram of seconds late
+    manager.handlerTime.<EventType>     histogram of seconds
+    simulator.tickDuration              histogram of seconds
+    simulator.overruns                  counter
+    simulator.messageQueueDepth         gauge
+    socket.<host>:<port>.bytesIn        counter (also messagesIn,
+                                        bytesOut and messagesOut)
+    socket.<host>:<port>.sends          counter of send calls
+"""
+
+import bisect, json
+
+import Timing
+
+enabled = False
+
+# bucket upper bounds, in seconds, from 10 microseconds to 10 seconds
+LATENCY_BUCKETS = tuple(base*10**exponent for exponent in xrange(-5, 1)
+                        for base in (1, 2, 5)) + (10,)
+
+class Counter(object):
+    """A value which only goes up."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+class Gauge(object):
+    """A value which is set to the latest measurement."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+class Histogram(object):
+    """
+    Counts values into buckets with fixed upper bounds.  Values above
+    the last bound go into a final overflow bucket.
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def getPercentile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the given fraction
+        of the values, or the maximum for the overflow bucket.
+        """
+        if not self.count:
+            return None
+        rank = fraction*self.count
+        seen = 0
+        for index, bucketCount in enumerate(self.counts):
+            seen += bucketCount
+            if seen >= rank and bucketCount:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'bounds': list(self.bounds),
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.getPercentile(0.50),
+            'p99': self.getPercentile(0.99),
+        }
+
+_metrics = {}
+
+def _getMetric(name, cls, *args):
+
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = cls(*args)
+    return metric
+
+def counter(name):
+    """Returns the Counter called 'name', creating it if necessary."""
+    return _getMetric(name, Counter)
+
+def gauge(name):
+    """Returns the Gauge called 'name', creating it if necessary."""
+    return _getMetric(name, Gauge)
+
+def histogram(name, bounds=LATENCY_BUCKETS):
+    """Returns the Histogram called 'name', creating it if necessary."""
+    return _getMetric(name, Histogram, bounds)
+
+def enable():
+    """Starts recording metrics."""
+    global enabled
+    enabled = True
+
+def disable():
+    """Stops recording metrics, keeping the values recorded so far."""
+    global enabled
+    enabled = False
+
+def reset():
+    """Forgets every metric."""
+    _metrics.clear()
+
+def snapshot():
+    """
+    Returns a dictionary with the time and the current value of every
+    metric.
+    """
+    return {
+        'time': Timing.mostAccurateTime(),
+        'metrics': dict((name, metric.snapshot())
+                        for name, metric in _metrics.items()),
+    }
+
+def writeSnapshot(path):
+    """Writes a snapshot to a JSON file at 'path'."""
+    outputFile = open(path, 'w')
+    try:
+        json.dump(snapshot(), outputFile, indent=1, sort_keys=True)
+    finally:
+        outputFile.close()
@@ -36,6 +36,9 @@ class ProxyableObject:
     # class dictionary which stores the attributes which will be
     # accessible to proxies
     __proxyMethods__ = {}
+    # StateHistory which records attribute changes for rollback, set
+    # per instance by StateHistory.track
+    __history__ = None
     
     def __init__(self):
 
@@ -53,9 +56,21 @@ class ProxyableObject:
         if name in self.__class__.__proxyAttrs__:
             self.__changedAttrs__[name] = value
 
+        # let the rollback history save the old value first
+        if self.__history__ is not None:
+            self.__history__.recordChange(self, name)
+
         # normal __setattr__ behavior
         self.__dict__[name] = value
 
+    def __getstate__(self):
+        """
+        Leaves the rollback history out when the object is pickled.
+        """
+        state = self.__dict__.copy()
+        state.pop('__history__', None)
+        return state
+
     def flushChanges(self):
         """
         Returns changes made to the instance since the previous call
@@ -11,9 +11,20 @@ Originally code written by Patrick Varin for Complete Galactic Dominion.
 """
 
 #import the necessary modules
-import socket, sys, traceback, threading
+import socket, select, errno, struct, sys, traceback, threading
 from threading import *
 
+import Timing
+import Instrumentation
+
+#messages end with a line holding NetworkEntity.STOP_MESSAGE
+LEGACY_FRAMING = 0
+#messages start with their length, as a 4 byte unsigned int in network
+#byte order
+LENGTH_PREFIXED_FRAMING = 1
+
+_FRAME_HEADER = struct.Struct('!I')
+
 class NetworkEntity(object):
     """
     The base class for Servers and Clients.
@@ -35,6 +46,50 @@ class NetworkEntity(object):
     STOP_MESSAGE='the_end_is_near'
     CLOSE_MESSAGE='shut_it_down'
     
+    '''
+    Define the byte which starts the control messages connections
+    exchange among themselves, e.g. to synchronize clocks.  Control
+    messages are handled by the connection and never reach
+    processInput.  Written messages which start with CONTROL_MARKER are
+    sent with a second one in front, which the other end removes, so any
+    message may be written.
+    '''
+    CONTROL_MARKER='\x00'
+    
+    '''
+    Define the prefixes of the control messages which synchronize
+    clocks, and of control messages which carry a timestamp.
+    '''
+    TIME_SYNC_REQUEST='time_sync_request'
+    TIME_SYNC_REPLY='time_sync_reply'
+    TIMED_MESSAGE='timed_message'
+    
+    '''
+    Define the prefixes of the control messages which negotiate the
+    framing of a connection, and the framing versions the entity accepts.  Every
+    connection starts with the STOP_MESSAGE framing (LEGACY_FRAMING);
+    see Connection.requestFraming.
+    '''
+    FRAMING_REQUEST='framing_request'
+    FRAMING_REPLY='framing_reply'
+    FRAMING_BEGIN='framing_begin'
+    FRAMING_VERSIONS=(LENGTH_PREFIXED_FRAMING,)
+    
+    '''
+    If zeroCopyInput is set, processInput receives each message as a
+    memoryview of the connection's receive buffer instead of a string.
+    The view is only valid until processInput returns, because the
+    buffer is reused for the following messages; call tobytes() on it
+    to keep the message.
+    '''
+    zeroCopyInput = False
+    
+    '''
+    If batchWrites is set, new connections start in batched mode, see
+    Connection.setBatched.
+    '''
+    batchWrites = False
+    
     def __init__(self,host,port):
         """
         Initialize the network entity
@@ -80,6 +135,23 @@ class NetworkEntity(object):
         """
         pass
     
+    def processTimedInput(self,sockThrd,data,eventTime):
+        """
+        This method handles messages sent with SocketThread.writeTimed.
+        By default, the timestamp is ignored and the data is passed on
+        to processInput.
+
+        @param sockThrd: the socket thread object that handles raw data from a socket
+        @type sockThrd: SocketThread
+
+        @param data: the string of data that can be sent across the network
+        @type data: string
+
+        @param eventTime: the message's timestamp, already translated to the local clock
+        @type eventTime: float
+        """
+        self.processInput(sockThrd, data)
+    
     def removeSocketThread(self,sockThrd):
         """
         This method should be overwritten in all non-abstract subclasses
@@ -118,12 +190,21 @@ class Server(NetworkEntity):
     @param connectionThread: the thread that manages the connections to clients
     @type connectionThread: Thread
 
-    @param socketThreads: a dictionary of socketThread objects that map sockets to their file-like socket objects
+    @param socketThreads: a dictionary which maps the connections to their sockets
     @type socketThreads: dict
+
+    @param ioThreads: the number of IOLoop threads which serve every client, or 0 to give each client its own SocketThread
+    @type ioThreads: int
+
+    @param ioLoops: the IOLoops which serve the clients, once the server is listening
+    @type ioLoops: list
     """
             
-    def __init__(self, host='', port=51423):
+    def __init__(self, host='', port=51423, ioThreads=0):
         NetworkEntity.__init__(self, host, port)
+        self.ioThreads = ioThreads
+        self.ioLoops = []
+        self._connectionCount = 0
         
         #specify TCP connection and other socket options
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -154,10 +235,23 @@ class Server(NetworkEntity):
         this code should be copied into the subclass's
         connectToAllClients method
         
+        If the server has ioThreads, clients are accepted on its first
+        IOLoop instead, and since IOLoop threads are daemonic, they do
+        not keep the program alive.
+        
         @param numPendingConnections: This specifies the number of clients that can be waiting for a connection at one time. The default is 5 on most operating systems.
         @type numPendingConnections: int
         """
         
+        if self.ioThreads:
+            #accept and serve every client on the IOLoops instead of
+            #starting threads
+            self.socket.listen(numPendingConnections)
+            self.connecting = True
+            self.ioLoops = [IOLoop() for i in xrange(self.ioThreads)]
+            self.ioLoops[0].register(_Listener(self))
+            return
+        
         def connectToAllClients():
             """
             The server's connectionThread will run in this method.
@@ -194,8 +288,46 @@ class Server(NetworkEntity):
             
     def addSocketThreadForClientSocket(self, clientSocket):
         #create a SocketThread object for clientSocket and add it to the socketThreads dictionary
-        s = SocketThread(self, clientSocket)
-        self.socketThreads[s] = s.file
+        if self.ioLoops:
+            #spread the clients evenly over the IOLoops
+            loop = self.ioLoops[self._connectionCount % len(self.ioLoops)]
+            self._connectionCount += 1
+            s = self.createConnection(clientSocket, loop)
+            #the loop may remove the connection as soon as it starts
+            self.socketThreads[s] = s.socket
+            s.start()
+        else:
+            s = SocketThread(self, clientSocket)
+            self.socketThreads[s] = s.socket
+    
+    def setBatched(self, batched):
+        """
+        Puts every connection, and those made later, in batched or
+        immediate mode, see Connection.setBatched.
+        """
+        self.batchWrites = batched
+        for sockThrd in self.socketThreads.keys():
+            sockThrd.setBatched(batched)
+    
+    def flushAll(self):
+        """
+        Sends the outbound queue of every connection.  In batched mode,
+        this should be called at the end of every tick.
+        """
+        for sockThrd in self.socketThreads.keys():
+            try:
+                sockThrd.flush()
+            except socket.error:
+                #the connection is closing; its reader will clean it up
+                pass
+    
+    def createConnection(self, clientSocket, loop):
+        """
+        Returns the connection which serves clientSocket on the IOLoop
+        'loop', when the server has ioThreads.  The connection is started
+        once it is in socketThreads.
+        """
+        return SelectorConnection(self, clientSocket, loop)
     
     def removeSocketThread(self, sockThrd):
         """
@@ -206,10 +338,7 @@ class Server(NetworkEntity):
         @type sockThrd: SocketThread
         """
         try:
-            print("Trying to remove ", sockThrd, " from SocketThreads dictionary...")
-            print("Existing SocketThreads: ", self.socketThreads)
             del(self.socketThreads[sockThrd])
-            print('Succeeded in removing socket thread from Server')
         except:
             traceback.print_exc()
             print('Failed to remove socket thread from Server')
@@ -228,6 +357,10 @@ class Server(NetworkEntity):
             if self.connectionThread:
                 print "Closed connection thread"
                 self.connectionThread.join()
+        
+        for loop in self.ioLoops:
+            loop.stop()
+        self.ioLoops = []
     
         try:
             print "Calling del on socketThread dictionary!"
@@ -277,8 +410,11 @@ class Client(NetworkEntity):
 
     @param connected: a flag indicating whether or not the Client has connected to a server
     @type connected: bool
+
+    @param framing: the framing to ask the server for, e.g. LENGTH_PREFIXED_FRAMING; servers which cannot use it keep LEGACY_FRAMING
+    @type framing: int
     """
-    def __init__(self,host='localhost',port=51423):
+    def __init__(self,host='localhost',port=51423,framing=LEGACY_FRAMING):
         NetworkEntity.__init__(self,host,port)
         
         #specify TCP connection and catch appropriate exceptions
@@ -300,6 +436,8 @@ class Client(NetworkEntity):
         
         self.connected=True
         self.socketThread=SocketThread(self,self.socket)
+        if framing != LEGACY_FRAMING:
+            self.socketThread.requestFraming(framing)
     
     def sendRequest(self, request):
         """
@@ -310,6 +448,29 @@ class Client(NetworkEntity):
         """
         self.socketThread.write(request)
     
+    def synchronizeClock(self, samples=8, interval=0.02, timeout=1.0):
+        """
+        Measures the offset between the client's and the server's clocks
+        by sending 'samples' time sync requests, 'interval' seconds
+        apart, and waiting up to 'timeout' seconds for the replies.
+        Calling this again from time to time keeps the estimate fresh.
+        Returns the SocketThread's TimeSync.
+
+        @param samples: the number of requests to send
+        @type samples: int
+        """
+        timeSync = self.socketThread.timeSync
+        expectedCount = timeSync.sampleCount + samples
+        for i in xrange(samples):
+            self.socketThread.requestTimeSync()
+            Timing.sleep(interval)
+        
+        deadline = Timing.mostAccurateTime() + timeout
+        while timeSync.sampleCount < expectedCount and \
+                Timing.mostAccurateTime() < deadline:
+            Timing.sleep(0.005)
+        return timeSync
+    
     def removeSocketThread(self, sockThrd):
         """
         Deletes the reference to the SocketThread from the socketThreads
@@ -335,121 +496,1051 @@ class Client(NetworkEntity):
             traceback.print_exc()
 
 
-class SocketThread(object):
+class TimeSync(object):
     """
-    A wrapper class for sockets. These sockets are managed in daemonic
-    threads, which terminate silently when all non-daemonic threads
-    terminate
+    Estimates the offset between the local clock and the clock at the
+    other end of a connection, and the round trip time, from NTP-style
+    samples.  A sample is made of the time a request was sent (t0), the
+    remote times it was received (t1) and answered (t2), and the time the
+    answer arrived (t3).
+    
+    Only the most recent 'window' samples are kept.  Samples with a long
+    round trip were probably delayed in one direction only, so just the
+    half of them with the shortest round trips are used, and the median
+    of their offsets is blended into the running estimate.
+
+    @param offset: remote clock minus local clock, in seconds
+    @type offset: float
+
+    @param rtt: the smoothed round trip time, in seconds
+    @type rtt: float
+    """
+    
+    def __init__(self, window=16, smoothing=0.25):
+        self.window = window
+        self.smoothing = smoothing
+        
+        self.offset = 0.0
+        self.rtt = None
+        self.sampleCount = 0
+        self._samples = []
+        self._lock = threading.Lock()
+    
+    def addSample(self, t0, t1, t2, t3):
+        """
+        Adds the sample of a completed request and updates the estimate.
+        """
+        rtt = max((t3 - t0) - (t2 - t1), 0.0)
+        offset = ((t1 - t0) + (t2 - t3)) / 2.0
+        
+        self._lock.acquire()
+        try:
+            self._samples.append((rtt, offset))
+            del self._samples[:-self.window]
+            
+            best = sorted(self._samples)[:max(1, len(self._samples)//2)]
+            offsets = sorted(sampleOffset for sampleRTT, sampleOffset in best)
+            estimate = offsets[len(offsets)//2]
+            
+            if self.rtt is None:
+                self.offset, self.rtt = estimate, rtt
+            else:
+                self.offset += self.smoothing*(estimate - self.offset)
+                self.rtt += self.smoothing*(rtt - self.rtt)
+            self.sampleCount += 1
+        finally:
+            self._lock.release()
+    
+    def setFromPeer(self, peerOffset, peerRTT):
+        """
+        Takes over the estimate made at the other end of the connection,
+        whose offset has the opposite sign.
+        """
+        self.offset = -peerOffset
+        self.rtt = peerRTT
+    
+    def toLocalTime(self, remoteTime):
+        """Translates a time on the remote clock to the local clock."""
+        return remoteTime - self.offset
+    
+    def toRemoteTime(self, localTime):
+        """Translates a time on the local clock to the remote clock."""
+        return localTime + self.offset
+
+
+def _parseValues(line, convert, count=None):
+    """
+    Returns the first 'count' (by default, all) words after the prefix of
+    the first line of a control message, converted with 'convert', or
+    None if there are too few of them or one cannot be converted.
+    """
+    values = line.split('\n', 1)[0].split()[1:]
+    if count is not None:
+        values = values[:count]
+        if len(values) < count:
+            return None
+    if not values:
+        return None
+    try:
+        return [convert(value) for value in values]
+    except ValueError:
+        return None
+
+class _ReceiveBuffer(object):
+    """
+    A bytearray which is reused to receive every message of a
+    connection.  The unread data lies between start and end.  Once the
+    end of the array is reached, the unread data is moved to the front,
+    or into a bigger array if it does not fit, so that messages never
+    wrap around the end and can be handed out as single memoryviews.
+    """
+
+    def __init__(self, size):
+
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.end = 0
+
+    def reserve(self, size):
+        """
+        Makes sure that 'size' bytes from start fit in the array.
+        """
+        if size <= len(self.data) - self.start:
+            return
+
+        unread = self.end - self.start
+        if size <= len(self.data):
+            self.data[:unread] = self.view[self.start:self.end].tobytes()
+        else:
+            #views of the old array may still be held, so it is replaced
+            #rather than resized
+            data = bytearray(max(size, 2*len(self.data)))
+            data[:unread] = self.view[self.start:self.end]
+            self.data, self.view = data, memoryview(data)
+        self.start, self.end = 0, unread
+
+    def receiveFrom(self, sock):
+        """
+        Receives from 'sock' into the free space after end.  Returns the
+        number of bytes received.
+        """
+        if self.end == len(self.data):
+            self.reserve(self.end - self.start + 1)
+        count = sock.recv_into(self.view[self.end:])
+        self.end += count
+        return count
+
+class Connection(object):
+    """
+    The base class for the objects which handle a single connection.
+    It sends and interprets the messages that connections exchange among
+    themselves, and hands everything else to the parent's processInput.
+    Subclasses decide how the socket is read and written.
 
     @param parent: a reference to the object that created it
     @type parent: NetworkEntity
 
-    @param thread: the thread that manages the socket
-    @type thread: Thread
-
     @param socket: the socket that communicates across the network
     @type socket: socket
 
-    @param file: the socket's file-like object, data can be written to and read from this object as if it were a file
-    @type file: socket.file ???
-
-    @param alive: a flag indicating whether or not the SocketThread is actively connected to the network
+    @param alive: a flag indicating whether or not the connection is actively connected to the network
     @type alive: bool
+
+    @param timeSync: the estimate of the clock offset and round trip time to the other end
+    @type timeSync: TimeSync
+
+    @param metricName: the prefix of the Instrumentation metrics of the socket
+    @type metricName: string
+
+    @param sendFraming: the framing of the messages written
+    @type sendFraming: int
+
+    @param receiveFraming: the framing of the messages read
+    @type receiveFraming: int
+
+    @param batched: whether written messages wait in the outbound queue for flush
+    @type batched: bool
     """
-    
+
+    # the initial size of the receive buffer
+    RECEIVE_BUFFER_SIZE = 65536
+    # the longest message accepted with LENGTH_PREFIXED_FRAMING
+    MAX_FRAME_SIZE = 1 << 26
+    # the outbound queue of a batched connection is flushed once it
+    # holds this many bytes
+    BATCH_SIZE = 65536
+
     def __init__(self,parent,sock):
         self.parent = parent
-        
-        #create the network manager thread in the processInput method of
-        #the SocketThread
-        self.thread = threading.Thread(target=self.processInput,args=())
         self.socket = sock
-        self.file = self.socket.makefile('rw',0)
         self.alive = True
-        self.thread.setDaemon(True)
-        self.thread.start()
-    
-    def write(self, message):
+        self.timeSync = TimeSync()
+        self.sendFraming = LEGACY_FRAMING
+        self.receiveFraming = LEGACY_FRAMING
+        self._framingRequested = False
+        #keeps messages whole, and switches of sendFraming between them
+        self._writeLock = threading.RLock()
+
+        #the outbound queue of batched mode
+        self.batched = parent.batchWrites
+        self._batch = []
+        self._batchSize = 0
+
+        self._receiveBuffer = _ReceiveBuffer(self.RECEIVE_BUFFER_SIZE)
+        #how far into the unread data the STOP_MESSAGE has been looked for
+        self._searchOffset = 0
+        try:
+            self.metricName = 'socket.%s:%d' % sock.getpeername()[:2]
+        except socket.error:
+            self.metricName = 'socket.%d' % id(self)
+
+    def write(self, message, flush=False):
         """
-        Wraps the socket's write method, allowing endline characters to
-        be included in the message. This happens by using
+        Sends a message, allowing endline characters to be included in
+        it. With LEGACY_FRAMING, this happens by using
         NetworkEntity.STOP_MESSAGE as the delimiter to indicate the end
-        of a message instead of an endline character
+        of a message instead of an endline character. With
+        LENGTH_PREFIXED_FRAMING, the message is sent after its length.
+
+        In batched mode, the message waits in the outbound queue until
+        flush is called or the queue holds BATCH_SIZE bytes.
 
         @param message: the message to be sent over the network
         @type message: string
+
+        @param flush: send the message, and any waiting before it, at once
+        @type flush: bool
         """
-        
-        #write everything to the socket
-        self.file.write(message+'\n')
-        #end the message with the STOP_MESSAGE delimiter
-        self.file.write(self.parent.STOP_MESSAGE+'\n')
-        #ensure that the message is sent across the network
-        self.file.flush()
-    
+
+        marker = self.parent.CONTROL_MARKER
+        if message.startswith(marker):
+            #escape the message, so it is not taken for a control message
+            message = marker+message
+        self._writeFrame(message, flush)
+
+    def _writeControl(self, message, flush=False):
+        """
+        Sends the control message 'message'.
+        """
+        self._writeFrame(self.parent.CONTROL_MARKER+message, flush)
+
+    def _writeFrame(self, message, flush):
+        """
+        Frames 'message' and sends it, or queues it in batched mode.
+        """
+        self._writeLock.acquire()
+        try:
+            if self.sendFraming == LENGTH_PREFIXED_FRAMING:
+                data = _FRAME_HEADER.pack(len(message))+message
+            else:
+                #end the message with the STOP_MESSAGE delimiter
+                data = message+'\n'+self.parent.STOP_MESSAGE+'\n'
+
+            if self.batched:
+                self._batch.append(data)
+                self._batchSize += len(data)
+                if flush or self._batchSize >= self.BATCH_SIZE:
+                    self.flush()
+            else:
+                self._sendData(data)
+        finally:
+            self._writeLock.release()
+
+        if Instrumentation.enabled:
+            self._recordTraffic('Out', len(data))
+
+    def flush(self):
+        """
+        Sends every message in the outbound queue with a single send.
+        """
+        self._writeLock.acquire()
+        try:
+            if not self._batch:
+                return
+            if len(self._batch) == 1:
+                data = self._batch[0]
+            else:
+                data = ''.join(self._batch)
+            self._batch = []
+            self._batchSize = 0
+            self._sendData(data)
+        finally:
+            self._writeLock.release()
+
+    def setBatched(self, batched):
+        """
+        Switches between immediate mode, where every write is sent at
+        once, and batched mode, where writes wait in the outbound queue
+        so that many messages go out in one send.  A server in batched
+        mode should flush its connections at the end of every tick, e.g.
+        with Server.flushAll.
+        """
+        self._writeLock.acquire()
+        try:
+            self.batched = batched
+            if not batched:
+                self.flush()
+        finally:
+            self._writeLock.release()
+
+    def _sendData(self, data):
+
+        self._send(data)
+        if Instrumentation.enabled:
+            Instrumentation.counter(self.metricName + '.sends').add()
+
+    def _send(self, data):
+        """
+        Sends the raw string 'data' across the network.  Subclasses
+        override this.
+        """
+        raise NotImplementedError
+
+    def _recordTraffic(self, direction, byteCount):
+        """
+        Counts a message of 'byteCount' bytes going in 'direction', which
+        is 'In' or 'Out'.
+        """
+        metricName = self.metricName
+        Instrumentation.counter(metricName + '.bytes' + direction).add(byteCount)
+        Instrumentation.counter(metricName + '.messages' + direction).add()
+
+    def writeTimed(self, message, eventTime):
+        """
+        Sends a message with a timestamp on the local clock.  The
+        timestamp is translated to the remote clock on the way, and is
+        handed to the remote entity's processTimedInput.
+
+        @param message: the message to be sent over the network
+        @type message: string
+
+        @param eventTime: the local time the message refers to
+        @type eventTime: float
+        """
+        self._writeControl('%s %r\n%s' % (self.parent.TIMED_MESSAGE,
+                                          self.timeSync.toRemoteTime(eventTime), message))
+
+    def requestTimeSync(self):
+        """
+        Sends a time sync request, which the other end answers
+        automatically.  The current estimate is sent along, so that the
+        other end can translate times as well.
+        """
+        timeSync = self.timeSync
+        self._writeControl('%s %r %r %r' % (self.parent.TIME_SYNC_REQUEST,
+                                            Timing.mostAccurateTime(),
+                                            timeSync.offset, timeSync.rtt or 0.0), True)
+
+    def requestFraming(self, version=LENGTH_PREFIXED_FRAMING):
+        """
+        Asks the other end to switch to the framing 'version'.  If it
+        accepts, it answers with FRAMING_REPLY and frames everything
+        after the reply with the new framing; this end then sends
+        FRAMING_BEGIN and does the same.  Until then, messages keep the
+        current framing, so nothing needs to wait for the answer.
+
+        Entities which predate framing negotiation hand the request to
+        their processInput, so it should only be sent to those which
+        support it.
+        """
+        self._framingRequested = True
+        self._writeControl('%s %d' % (self.parent.FRAMING_REQUEST, version))
+
+    def _switchSendFraming(self, message, version):
+        """
+        Sends the control message 'message' and frames everything after
+        it with 'version'.
+        """
+        self._writeLock.acquire()
+        try:
+            self._writeControl(message)
+            self.sendFraming = version
+        finally:
+            self._writeLock.release()
+
+    def toLocalTime(self, remoteTime):
+        return self.timeSync.toLocalTime(remoteTime)
+
+    def toRemoteTime(self, localTime):
+        return self.timeSync.toRemoteTime(localTime)
+
+    def processControlMessage(self, line, receiveTime):
+        """
+        Handles 'line', a control message without its CONTROL_MARKER.
+        Returns False if it is malformed or unknown.
+        """
+        parent = self.parent
+        if line.startswith(parent.TIME_SYNC_REQUEST+' '):
+            values = _parseValues(line, float, 3)
+            if values is None:
+                return False
+            t0, peerOffset, peerRTT = values
+            if peerRTT:
+                self.timeSync.setFromPeer(peerOffset, peerRTT)
+            self._writeControl('%s %r %r %r' % (parent.TIME_SYNC_REPLY, t0,
+                                                receiveTime, Timing.mostAccurateTime()),
+                               True)
+            return True
+
+        if line.startswith(parent.TIME_SYNC_REPLY+' '):
+            values = _parseValues(line, float, 3)
+            if values is None:
+                return False
+            t0, t1, t2 = values
+            self.timeSync.addSample(t0, t1, t2, receiveTime)
+            return True
+
+        if line.startswith(parent.TIMED_MESSAGE+' '):
+            values = _parseValues(line, float, 1)
+            if values is None or '\n' not in line:
+                return False
+            data = line.split('\n', 1)[1]
+            eventTime = self.timeSync.toLocalTime(values[0])
+            parent.processTimedInput(self, data, eventTime)
+            return True
+
+        if line.startswith(parent.FRAMING_REQUEST+' '):
+            versions = _parseValues(line, int)
+            if versions is None:
+                return False
+            #only the end which did not ask answers, so that an echoed
+            #request is not taken for one
+            if not self._framingRequested:
+                versions = set(versions) & set(parent.FRAMING_VERSIONS)
+                version = max(versions or [LEGACY_FRAMING])
+                self._switchSendFraming('%s %d' % (parent.FRAMING_REPLY, version),
+                                        version)
+            return True
+
+        if line.startswith(parent.FRAMING_REPLY+' '):
+            values = _parseValues(line, int, 1)
+            if values is None or not self._isFramingKnown(values[0]):
+                return False
+            version = values[0]
+            if version != LEGACY_FRAMING:
+                #everything after the reply has the new framing
+                self.receiveFraming = version
+                self._switchSendFraming('%s %d' % (parent.FRAMING_BEGIN, version),
+                                        version)
+            return True
+
+        if line.startswith(parent.FRAMING_BEGIN+' '):
+            values = _parseValues(line, int, 1)
+            if values is None or not self._isFramingKnown(values[0]):
+                return False
+            self.receiveFraming = values[0]
+            return True
+
+        return False
+
+    def _isFramingKnown(self, version):
+
+        return version == LEGACY_FRAMING or version in self.parent.FRAMING_VERSIONS
+
+    def receive(self):
+        """
+        Receives what the socket has into the receive buffer, with a
+        single recv_into call.  Returns the number of bytes received,
+        which is 0 once the other end has closed the connection.
+        """
+        return self._receiveBuffer.receiveFrom(self.socket)
+
+    def processReceived(self, receiveTime):
+        """
+        Delivers every complete message in the receive buffer, which
+        arrived at 'receiveTime'.  Returns False if the connection should
+        be closed, because the other end sent the CLOSE_MESSAGE or a
+        message longer than MAX_FRAME_SIZE.
+        """
+        buffer = self._receiveBuffer
+        headerSize = _FRAME_HEADER.size
+        stopMarker = '\n'+self.parent.STOP_MESSAGE+'\n'
+
+        #the framing may change after any message, so it is checked for
+        #each one
+        while self.alive:
+            start, end = buffer.start, buffer.end
+            if self.receiveFraming == LENGTH_PREFIXED_FRAMING:
+                if end - start < headerSize:
+                    break
+                length, = _FRAME_HEADER.unpack_from(buffer.data, start)
+                if length > self.MAX_FRAME_SIZE:
+                    return False
+                if start + headerSize + length > end:
+                    #make room for the whole message, so the rest of it
+                    #is received in place
+                    buffer.reserve(headerSize + length)
+                    break
+                messageStart = start + headerSize
+                messageEnd = buffer.start = messageStart + length
+            else:
+                found = buffer.data.find(stopMarker, start + self._searchOffset, end)
+                if found < 0:
+                    #the marker may have been cut off at the end
+                    self._searchOffset = max(end - start - len(stopMarker) + 1, 0)
+                    break
+                self._searchOffset = 0
+                #the message keeps its last endline, as with older versions
+                messageStart, messageEnd = start, found + 1
+                buffer.start = found + len(stopMarker)
+
+            if not self._deliverFrame(messageStart, messageEnd, receiveTime):
+                return False
+
+        if buffer.start == buffer.end:
+            buffer.start = buffer.end = 0
+        return True
+
+    def _deliverFrame(self, start, end, receiveTime):
+        """
+        Delivers the message between 'start' and 'end' in the receive
+        buffer.  Returns False if it was the CLOSE_MESSAGE.
+        """
+        parent = self.parent
+        buffer = self._receiveBuffer
+
+        #only short messages can be the CLOSE_MESSAGE
+        if (end - start <= len(parent.CLOSE_MESSAGE) + 2 and
+                buffer.view[start:end].tobytes().strip() == parent.CLOSE_MESSAGE):
+            return False
+
+        if buffer.data.startswith(parent.CONTROL_MARKER, start, end):
+            self.deliver(buffer.view[start:end].tobytes(), receiveTime)
+            return True
+
+        if Instrumentation.enabled:
+            self._recordReceived(end - start)
+        if parent.zeroCopyInput:
+            self.dispatchInput(buffer.view[start:end])
+        else:
+            self.dispatchInput(buffer.view[start:end].tobytes())
+        return True
+
+    def deliver(self, line, receiveTime):
+        """
+        Handles a complete message which arrived at 'receiveTime': control
+        messages are handled here, and everything else is sent to the
+        parent's processInput method.
+        """
+        if Instrumentation.enabled:
+            self._recordReceived(len(line))
+
+        marker = self.parent.CONTROL_MARKER
+        if not line.startswith(marker):
+            self.dispatchInput(line)
+        elif line.startswith(marker, 1):
+            #an escaped message
+            self.dispatchInput(line[1:])
+        elif not self.processControlMessage(line[1:], receiveTime):
+            print 'Ignoring malformed control message %r' % line[1:]
+
+    def _recordReceived(self, length):
+
+        if self.receiveFraming == LENGTH_PREFIXED_FRAMING:
+            self._recordTraffic('In', length + _FRAME_HEADER.size)
+        else:
+            self._recordTraffic('In', length + len(self.parent.STOP_MESSAGE) + 1)
+
+    def dispatchInput(self, line):
+        """
+        Hands a message which is not a control message to the parent's
+        processInput method.  Subclasses may override this to route
+        messages elsewhere.
+        """
+        self.parent.processInput(self, line)
+
+class SocketThread(Connection):
+    """
+    Inherits from Connection
+
+    A wrapper class for sockets. These sockets are managed in daemonic
+    threads, which terminate silently when all non-daemonic threads
+    terminate
+
+    @param thread: the thread that manages the socket
+    @type thread: Thread
+    """
+
+    def __init__(self,parent,sock):
+        Connection.__init__(self, parent, sock)
+
+        #create the network manager thread in the processInput method of
+        #the SocketThread
+        self.thread = threading.Thread(target=self.processInput,args=())
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _send(self, data):
+
+        #write everything to the socket in one call, however large
+        self.socket.sendall(data)
+
     def processInput(self):
         """
         The method that the thread runs in.
         This will listen continuously to the network for information and
         post this information to the parent's processInput method
         """
-        
+
         #run while the SocketThread is alive
         while self.alive:
-            print "Processing..."
-            
-            #initialize the line string
-            line = ''
-            
-            #this is a flag that is used to find the end of the message
-            flag = False
-            
-            #iterate through the lines in the file-like object
-            for nline in self.file:
-                flag = True
-                #check to see if the message has ended
-                if nline.strip() == self.parent.STOP_MESSAGE:
-                    break
-                #append the n(ext)line to the cumulative line
-                line+=nline 
-            
+            try:
+                count = self.receive()
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                count = 0
+
             #check for the CLOSE_MESSAGE
-            if line.strip() == self.parent.CLOSE_MESSAGE or flag == False:
+            if not count or not self.processReceived(Timing.mostAccurateTime()):
                 print "Socket thread "+self.__str__()+" got CLOSE_MESSAGE. Deleting now."
                 self.__del__()
                 return
-            
-            flag = False
-            
-            #send the data to the parent's processInput method
-            self.parent.processInput(self, line)
-            line = ''
-    
+
     def __del__(self):
         """
         Deletes the SocketThread and lets the network know that the
         SocketThread has been deleted
         """
-        
+
         print "Called del on SocketThread ", self
-        
+
         self.alive = False
-        if self.thread:
+        #the thread deletes its own SocketThread when the other end closes
+        if self.thread and self.thread is not threading.currentThread():
             self.thread.join()
         self.parent.removeSocketThread(self)
-        
+
         #tell the entity on the other side of the network to delete the socket
         try:
-            self.write(self.parent.CLOSE_MESSAGE)
+            self.write(self.parent.CLOSE_MESSAGE, True)
         except:
             pass
-        
+
         #close the network connection
         try:
             self.socket.close()
         except:
             pass
 
+# errors of non-blocking sockets which only mean "try again later"
+_RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+class _Poller(object):
+    """
+    Watches file descriptors for reading and writing with the best
+    mechanism the platform has: epoll, then poll, then select.
+    """
+
+    def __init__(self):
+
+        if hasattr(select, 'epoll'):
+            self._poll = select.epoll()
+            self._readMask = select.EPOLLIN
+            self._writeMask = select.EPOLLOUT
+            self._errorMask = select.EPOLLERR | select.EPOLLHUP
+            self._timeoutScale = 1
+        elif hasattr(select, 'poll'):
+            self._poll = select.poll()
+            self._readMask = select.POLLIN
+            self._writeMask = select.POLLOUT
+            self._errorMask = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            self._timeoutScale = 1000
+        else:
+            self._poll = None
+            self._readers = set()
+            self._writers = set()
+
+    def register(self, fd, writable=False):
+
+        if self._poll is None:
+            self._readers.add(fd)
+            if writable:
+                self._writers.add(fd)
+        else:
+            self._poll.register(fd, self._mask(writable))
+
+    def modify(self, fd, writable):
+
+        if self._poll is None:
+            if writable:
+                self._writers.add(fd)
+            else:
+                self._writers.discard(fd)
+        else:
+            self._poll.modify(fd, self._mask(writable))
+
+    def unregister(self, fd):
+
+        if self._poll is None:
+            self._readers.discard(fd)
+            self._writers.discard(fd)
+        else:
+            self._poll.unregister(fd)
+
+    def _mask(self, writable):
+
+        if writable:
+            return self._readMask | self._writeMask
+        return self._readMask
+
+    def poll(self, timeout=None):
+        """
+        Waits up to 'timeout' seconds (forever if None) for a descriptor
+        to become ready.  Returns a list of (fd, readable, writable)
+        tuples; errors and hang ups count as readable, so that the
+        following read finds them.
+        """
+        try:
+            if self._poll is None:
+                readable, writable, errors = select.select(
+                    self._readers, self._writers, [], timeout)
+                readable, writable = set(readable), set(writable)
+                return [(fd, fd in readable, fd in writable)
+                        for fd in readable | writable]
+
+            if timeout is None:
+                timeout = -1
+            else:
+                timeout *= self._timeoutScale
+            readMask = self._readMask | self._errorMask
+            return [(fd, bool(mask & readMask), bool(mask & self._writeMask))
+                    for fd, mask in self._poll.poll(timeout)]
+        except (select.error, IOError), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+def _socketPair():
+    """
+    Returns two connected sockets, so that one thread can wake another
+    which is waiting in select.
+    """
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        first = socket.create_connection(listener.getsockname())
+        second = listener.accept()[0]
+    finally:
+        listener.close()
+    return first, second
+
+class IOLoop(object):
+    """
+    Runs the non-blocking sockets registered with it on a single daemon
+    thread.  Each registered object has a fileno method and a handleRead
+    method, a handleWrite method which is called while it is watched for
+    writing, and a close method which is called if either fails.
+
+    The registration methods may be called from any thread.  Changes
+    are handed to the loop thread with callSoon, so that only that
+    thread ever touches the poller.
+    """
+
+    def __init__(self):
+
+        self._poller = _Poller()
+        self._handlers = {}
+
+        # functions for the loop thread to call, and the socket pair
+        # used to wake it up for them
+        self._calls = []
+        self._callsLock = threading.Lock()
+        self._wakeReader, self._wakeWriter = _socketPair()
+        self._wakeReader.setblocking(0)
+        self._wakeWriter.setblocking(0)
+        self._poller.register(self._wakeReader.fileno())
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def callSoon(self, function, *args):
+        """
+        Makes the loop thread call function(*args) before it next waits.
+        """
+        self._callsLock.acquire()
+        try:
+            self._calls.append((function, args))
+            wake = len(self._calls) == 1
+        finally:
+            self._callsLock.release()
+
+        if wake and threading.currentThread() is not self.thread:
+            try:
+                self._wakeWriter.send('x')
+            except socket.error, e:
+                # the pair is full, so the loop is woken already
+                if e.args[0] not in _RETRY_ERRORS:
+                    raise
+
+    def register(self, handler, writable=False):
+
+        self.callSoon(self._register, handler, writable)
+
+    def setWritable(self, handler, writable):
+        """
+        Starts or stops calling handleWrite when the handler's socket
+        can be written to.
+        """
+        self.callSoon(self._setWritable, handler, writable)
+
+    def unregister(self, handler, close=False):
+        """
+        Stops watching the handler's socket, and closes it with 'close'.
+        """
+        self.callSoon(self._unregister, handler, close)
+
+    def _register(self, handler, writable):
+
+        fd = handler.fileno()
+        self._handlers[fd] = handler
+        self._poller.register(fd, writable)
+
+    def _setWritable(self, handler, writable):
+
+        fd = handler.fileno()
+        if self._handlers.get(fd) is handler:
+            self._poller.modify(fd, writable)
+
+    def _unregister(self, handler, close):
+
+        fd = handler.fileno()
+        if self._handlers.get(fd) is handler:
+            del self._handlers[fd]
+            self._poller.unregister(fd)
+        if close:
+            handler.socket.close()
+
+    def _runCalls(self):
+
+        self._callsLock.acquire()
+        try:
+            calls, self._calls = self._calls, []
+        finally:
+            self._callsLock.release()
+
+        for function, args in calls:
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def run(self):
+
+        wakeFD = self._wakeReader.fileno()
+        handlers = self._handlers
+
+        while self.running:
+            self._runCalls()
+
+            #calls made by the calls above must not wait for the poll
+            if self._calls:
+                timeout = 0
+            else:
+                timeout = None
+
+            for fd, readable, writable in self._poller.poll(timeout):
+                if fd == wakeFD:
+                    try:
+                        while self._wakeReader.recv(4096):
+                            pass
+                    except socket.error:
+                        pass
+                    continue
+
+                handler = handlers.get(fd)
+                if handler is None:
+                    continue
+                try:
+                    if readable:
+                        handler.handleRead()
+                    if writable and handler.alive:
+                        handler.handleWrite()
+                except Exception:
+                    # a failing connection must not take the loop down
+                    traceback.print_exc()
+                    handler.close()
+
+        for handler in handlers.values():
+            handler.close()
+        self._runCalls()
+        self._wakeReader.close()
+        self._wakeWriter.close()
+
+    def stop(self):
+        """
+        Closes every socket of the loop and ends its thread.
+        """
+        self.running = False
+        self.callSoon(lambda: None)
+        if threading.currentThread() is not self.thread:
+            self.thread.join()
+
+class SelectorConnection(Connection):
+    """
+    Inherits from Connection
+
+    A connection which is read and written without blocking by an
+    IOLoop, so that one thread can serve many clients.  It speaks the
+    same protocol as SocketThread, and its processInput calls happen on
+    the loop's thread.
+
+    Writes may come from any thread.  They are sent at once when the
+    socket can take them, and otherwise are buffered until the loop
+    finds the socket writable.
+
+    Nothing is read until start is called.
+
+    @param loop: the IOLoop which serves the connection
+    @type loop: IOLoop
+    """
+
+    def __init__(self,parent,sock,loop):
+        Connection.__init__(self, parent, sock)
+        self.loop = loop
+        self._fd = sock.fileno()
+        sock.setblocking(0)
+
+        self._outBuffer = []
+        self._outLock = threading.Lock()
+
+    def start(self):
+        """
+        Starts serving the connection on its loop.  Anything which must
+        be in place when the first message or the close arrives, such as
+        the entry in the server's socketThreads, must be set up first.
+        """
+        self.loop.register(self)
+
+    def fileno(self):
+        return self._fd
+
+    def _send(self, data):
+
+        self._outLock.acquire()
+        try:
+            if not self.alive:
+                raise socket.error(errno.EPIPE, 'Connection is closed')
+            if self._outBuffer:
+                # keep the order behind what is already waiting
+                self._outBuffer.append(data)
+                return
+
+            try:
+                sent = self.socket.send(data)
+            except socket.error, e:
+                if e.args[0] not in _RETRY_ERRORS:
+                    raise
+                sent = 0
+            if sent < len(data):
+                self._outBuffer.append(data[sent:])
+                self.loop.setWritable(self, True)
+        finally:
+            self._outLock.release()
+
+    def handleWrite(self):
+        """
+        Called by the loop when the socket can be written to.
+        """
+        self._outLock.acquire()
+        try:
+            if not self._outBuffer:
+                return
+            data = ''.join(self._outBuffer)
+            try:
+                sent = self.socket.send(data)
+            except socket.error, e:
+                if e.args[0] not in _RETRY_ERRORS:
+                    raise
+                sent = 0
+            if sent < len(data):
+                self._outBuffer = [data[sent:]]
+            else:
+                self._outBuffer = []
+                self.loop.setWritable(self, False)
+        finally:
+            self._outLock.release()
+
+    def handleRead(self):
+        """
+        Called by the loop when the socket has data, or has been closed
+        by the other end.  Delivers every complete message.
+        """
+        try:
+            count = self.receive()
+        except socket.error, e:
+            if e.args[0] in _RETRY_ERRORS:
+                return
+            count = 0
+
+        if not count or not self.processReceived(Timing.mostAccurateTime()):
+            self.close(False)
+
+    def close(self, notifyPeer=True):
+        """
+        Closes the connection, telling the other end to close it as well
+        with 'notifyPeer'.
+        """
+        if not self.alive:
+            return
+
+        if notifyPeer:
+            #tell the entity on the other side of the network to delete the socket
+            try:
+                self.write(self.parent.CLOSE_MESSAGE, True)
+            except:
+                pass
+
+        self._outLock.acquire()
+        self.alive = False
+        self._outLock.release()
+
+        self.parent.removeSocketThread(self)
+        self.loop.unregister(self, True)
+
+class _Listener(object):
+    """
+    Accepts the clients of a Server on an IOLoop.
+    """
+
+    alive = True
+
+    def __init__(self, server):
+
+        self.server = server
+        self.socket = server.socket
+        self.socket.setblocking(0)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def handleRead(self):
+
+        while True:
+            try:
+                clientSocket = self.socket.accept()[0]
+            except socket.error, e:
+                if e.args[0] in _RETRY_ERRORS or e.args[0] == errno.ECONNABORTED:
+                    return
+                raise
+            #accepted sockets can inherit non-blocking mode
+            clientSocket.setblocking(1)
+            self.server.addSocketThreadForClientSocket(clientSocket)
+
+    def handleWrite(self):
+        pass
+
+    def close(self):
+
+        self.alive = False
+
 #########################\n
 #    Server Examples    #\n
 #########################\n
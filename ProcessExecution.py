@@ -0,0 +1,273 @@
+"""
+Process Execution
+--------------------
+Summary: Executes events on worker processes which own the objects the
+events change.
+
+Because of how cPython is implemented, only processes truly run
+simultaneously, so CPU-bound events (pathfinding, combat resolution)
+executed by the threads of an Event.Manager are pinned to a single core.
+
+A ProcessManager gives every NetworkObject an owner process, chosen by
+its ID.  Each worker keeps its own copy of the objects it owns, and due
+events are sent, in order and in a single message per worker, to the
+worker which owns the object they target.  Once a worker has executed
+its events, it sends back the attributes which changed on each object,
+and those changes are applied to the objects in the main process, where
+they are tracked for proxies as usual.  Events which touch disjoint
+objects therefore run in parallel without any locks.
+
+Attributes which the main process changes on an object, for instance in
+an event without a target, are sent to its owner along with the next
+events which target it, so the worker's copy is up to date when they
+execute.  Both sides compare attribute values by identity, so state must
+be changed by setting attributes rather than by mutating their values
+in place.
+
+Events choose their object by returning its ID from getTargetID, and are
+executed by applyTo(obj), which receives the worker's copy of the object.
+Events without a target are executed in the main process, in time order
+with the others: the targeted events before one are executed, and their
+changes applied, before it runs.  Events and objects are pickled on
+their way to the workers, so objects should refer to each other by ID
+rather than directly.
+"""
+
+import multiprocessing, traceback
+
+from Event import Manager
+
+_missing = object()
+
+# attributes which belong to the process the object is in
+_LOCAL_ATTRIBUTES = ('__changedAttrs__', '__history__')
+
+def _getChanges(before, obj):
+    """
+    Returns the attributes of 'obj' which differ from the dictionary
+    'before'.
+    """
+    changes = {}
+    for name, value in obj.__dict__.iteritems():
+        if name not in _LOCAL_ATTRIBUTES and before.get(name, _missing) is not value:
+            changes[name] = value
+    return changes
+
+def _getDeletions(before, obj):
+    """
+    Returns the names in the dictionary 'before' which 'obj' no longer
+    has.
+    """
+    objDict = obj.__dict__
+    return [name for name in before
+            if name not in objDict and name not in _LOCAL_ATTRIBUTES]
+
+def _work(connection):
+    """
+    The main loop of a worker process.  Receives (command, argument)
+    messages from the main process until told to stop.
+    """
+    objects = {}
+
+    while True:
+        command, argument = connection.recv()
+
+        if command == 'execute':
+            updates, events = argument
+            # bring the copies up to date with the main process first
+            for ID, (objChanges, deletions) in updates.iteritems():
+                obj = objects.get(ID)
+                if obj is not None:
+                    obj.__dict__.update(objChanges)
+                    for name in deletions:
+                        obj.__dict__.pop(name, None)
+
+            touched = {}
+            for event in events:
+                ID = event.getTargetID()
+                obj = objects.get(ID)
+                if obj is None:
+                    print 'Warning: event for unknown object %s.' % (ID,)
+                    continue
+                if ID not in touched:
+                    touched[ID] = dict(obj.__dict__)
+                try:
+                    event.applyTo(obj)
+                except Exception:
+                    # a failing event must not take the worker down
+                    traceback.print_exc()
+
+            changes = {}
+            for ID, before in touched.iteritems():
+                obj = objects[ID]
+                # the main process tracks proxy changes itself
+                obj.flushChanges()
+                objChanges = _getChanges(before, obj)
+                if objChanges:
+                    changes[ID] = objChanges
+            connection.send(changes)
+
+        elif command == 'add':
+            for obj in argument:
+                objects[obj.getID()] = obj
+
+        elif command == 'remove':
+            for ID in argument:
+                objects.pop(ID, None)
+
+        elif command == 'stop':
+            connection.close()
+            return
+
+class ProcessManager(Manager):
+    """
+    An event Manager which executes each tick's due events on a fixed
+    pool of worker processes, partitioned by the ID of the NetworkObject
+    they target.  The objects registered with 'creator' when the manager
+    is created are copied to their owners; objects created later must be
+    passed to addObject.
+    """
+
+    def __init__(self, creator, queue=None, processCount=None):
+
+        Manager.__init__(self, queue)
+
+        if processCount is None: processCount = multiprocessing.cpu_count()
+
+        self.creator = creator
+        self.processCount = processCount
+
+        # the attributes of every object as its owner last saw them
+        self._synced = {}
+
+        self._connections = []
+        self._processes = []
+        for i in xrange(processCount):
+            connection, workerConnection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_work,
+                                              args=(workerConnection,))
+            process.daemon = True
+            process.start()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+        self.addObjects(self.creator.IDsToObjects.values())
+
+    def _getOwner(self, ID):
+        """
+        Returns the index of the worker which owns the object with 'ID'.
+        """
+        return hash(ID) % self.processCount
+
+    def _send(self, command, items, getID):
+        """
+        Sends 'command' to every worker which owns at least one of
+        'items', along with the items it owns.  Returns the indices of
+        the workers which were sent a message.
+        """
+        partitions = {}
+        for item in items:
+            partitions.setdefault(self._getOwner(getID(item)), []).append(item)
+
+        for owner, ownedItems in partitions.iteritems():
+            self._connections[owner].send((command, ownedItems))
+        return partitions.keys()
+
+    def addObject(self, obj):
+        """
+        Copies 'obj' to the worker which owns it.  Must be called for
+        every NetworkObject created after the manager.
+        """
+        self.addObjects([obj])
+
+    def addObjects(self, objects):
+        """
+        Copies every object in 'objects' to the worker which owns it.
+        """
+        for obj in objects:
+            self._synced[obj.getID()] = dict(obj.__dict__)
+        self._send('add', objects, lambda obj: obj.getID())
+
+    def removeObject(self, obj):
+        """
+        Removes the worker's copy of 'obj'.
+        """
+        self._synced.pop(obj.getID(), None)
+        self._send('remove', [obj.getID()], lambda ID: ID)
+
+    def tick(self, currentTime=None):
+        """
+        Executes every event which is due by currentTime, and applies the
+        resulting changes to the objects in this process.  Returns the
+        number of events executed.
+        """
+        events = self.queue.getNextEvents(currentTime)
+        if not events:
+            return 0
+
+        targeted = []
+        for event in events:
+            if event.getTargetID() is None:
+                # the events before it must have happened when it runs
+                self._executeTargeted(targeted)
+                targeted = []
+                try:
+                    self.handler(event)
+                except Exception:
+                    traceback.print_exc()
+            else:
+                targeted.append(event)
+        self._executeTargeted(targeted)
+
+        return len(events)
+
+    def _executeTargeted(self, events):
+        """
+        Executes 'events', which all have a target, on the workers which
+        own their targets, and applies the resulting changes here.
+        """
+        if not events:
+            return
+
+        partitions = {}
+        for event in events:
+            partitions.setdefault(self._getOwner(event.getTargetID()), []).append(event)
+
+        IDsToObjects = self.creator.IDsToObjects
+        synced = self._synced
+
+        # every worker executes its events while the others do theirs
+        for owner, ownedEvents in partitions.iteritems():
+            updates = {}
+            for ID in set(event.getTargetID() for event in ownedEvents):
+                obj = IDsToObjects.get(ID)
+                before = synced.get(ID)
+                if obj is None or before is None:
+                    continue
+                objChanges = _getChanges(before, obj)
+                deletions = _getDeletions(before, obj)
+                if objChanges or deletions:
+                    updates[ID] = (objChanges, deletions)
+                    synced[ID] = dict(obj.__dict__)
+            self._connections[owner].send(('execute', (updates, ownedEvents)))
+
+        for owner in partitions:
+            for ID, changes in self._connections[owner].recv().iteritems():
+                obj = IDsToObjects.get(ID)
+                if obj is not None:
+                    for name, value in changes.iteritems():
+                        # goes through __setattr__, so proxies see the change
+                        setattr(obj, name, value)
+                    synced[ID] = dict(obj.__dict__)
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker processes.
+        """
+        for connection in self._connections:
+            connection.send(('stop', None))
+            connection.close()
+        if wait:
+            for process in self._processes:
+                process.join()
+        Manager.shutdown(self, wait)
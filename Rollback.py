@@ -0,0 +1,228 @@
+"""
+Rollback
+--------------------
+Summary: Executes events which arrive late by rolling the simulation back
+and simulating forward again, instead of dropping them.
+
+A StateHistory keeps an undo record for each of the last 'maxTicks'
+ticks.  The first time an attribute of a tracked ProxyableObject is set
+during a tick, the same __setattr__ hook which fills __changedAttrs__
+hands the old value to the history.  A tick's record therefore only
+holds the attributes which changed in it, and the cost of keeping
+history grows with the amount of change, not with the size of the world.
+Rolling back applies the records in reverse.
+
+A RollbackSimulation runs fixed ticks of events from a queue and
+remembers which events ran in each tick.  When an event arrives for a
+tick which has already been simulated, the simulation rolls back to the
+start of that tick and executes that tick and every later one again,
+with the late event in its place.
+
+Only attribute assignments are recorded, so state must be changed by
+setting attributes rather than by mutating their values in place.
+Objects created during a rolled back tick are not removed.  Events run
+again during re-simulation, so they must be deterministic.
+"""
+
+import bisect
+from collections import deque
+
+import Event
+
+_missing = object()
+
+class StateHistory:
+    """
+    Records the old values of the attributes which change in each tick,
+    for the last 'maxTicks' ticks.
+    """
+
+    def __init__(self, creator=None, maxTicks=32):
+
+        self.maxTicks = maxTicks
+        # (tickTime, {obj: {name: oldValue}}) for every remembered tick
+        self._ticks = deque()
+        self._current = None
+
+        if creator is not None:
+            for obj in creator.IDsToObjects.itervalues():
+                self.track(obj)
+
+    def track(self, obj):
+        """
+        Starts recording the attribute changes of 'obj'.
+        """
+        obj.__dict__['__history__'] = self
+
+    def untrack(self, obj):
+
+        obj.__dict__.pop('__history__', None)
+
+    def beginTick(self, tickTime):
+        """
+        Starts the undo record of the tick beginning at 'tickTime'.
+        """
+        self._current = {}
+        self._ticks.append((tickTime, self._current))
+        if len(self._ticks) > self.maxTicks:
+            self._ticks.popleft()
+
+    def recordChange(self, obj, name):
+        """
+        Called by ProxyableObject.__setattr__ before 'name' is set on
+        'obj'.  Saves the old value the first time it changes in a tick.
+        """
+        current = self._current
+        if current is None or name == '__changedAttrs__':
+            return
+        oldValues = current.get(obj)
+        if oldValues is None:
+            oldValues = current[obj] = {}
+        if name not in oldValues:
+            oldValues[name] = obj.__dict__.get(name, _missing)
+
+    def getOldestTickTime(self):
+        """
+        Returns the start of the earliest tick which can be rolled back
+        to, or None if there is none.
+        """
+        if not self._ticks:
+            return None
+        return self._ticks[0][0]
+
+    def rollback(self, tickTime):
+        """
+        Restores every tracked object to its state at the start of the
+        latest remembered tick which began before 'tickTime', and forgets
+        the undone ticks.  Returns the start of that tick.
+        """
+        ticks = self._ticks
+        while ticks:
+            startTime, oldValues = ticks.pop()
+            for obj, values in oldValues.iteritems():
+                objDict = obj.__dict__
+                proxyAttrs = obj.__class__.__proxyAttrs__
+                for name, value in values.iteritems():
+                    # bypass __setattr__, so the undo is not recorded
+                    if value is _missing:
+                        objDict.pop(name, None)
+                        # proxies have no way to delete an attribute, so
+                        # only the change made since is taken back
+                        if name in proxyAttrs:
+                            obj.__changedAttrs__.pop(name, None)
+                    else:
+                        objDict[name] = value
+                        if name in proxyAttrs:
+                            obj.__changedAttrs__[name] = value
+            if startTime < tickTime:
+                break
+
+        self._current = None
+        return startTime
+
+class RollbackSimulation:
+    """
+    Executes the events on 'queue' in fixed ticks of 'timestep' seconds,
+    starting at 'startTime', while recording the state of the objects of
+    'creator' for the last 'historyTicks' ticks.  Events which arrive for
+    a tick that has been simulated are executed by rolling back and
+    simulating forward again; only events older than the history are
+    dropped.
+    """
+
+    def __init__(self, creator, startTime, timestep=0.05, historyTicks=32,
+                 queue=None, handler=None):
+
+        if queue is None: queue = Event.EventQueue1(startTime)
+        if handler is None: handler = Event._executeEvent
+
+        self.queue = queue
+        self.handler = handler
+        self.timestep = timestep
+        self.startTime = startTime
+        self.currentTime = startTime
+        # ticks are numbered, so that their times do not accumulate
+        # rounding errors
+        self.tickCount = 0
+        self.history = StateHistory(creator, historyTicks)
+
+        # (tickTime, events executed in the tick) for every remembered tick
+        self._executed = deque()
+
+        self.rollbackCount = 0
+        self.missedCount = 0
+
+    def addEvent(self, event):
+        """
+        Adds 'event' to the simulation.  Returns False if the event is too
+        late to be rolled back to.
+        """
+        eventTime = event.getTime()
+        if eventTime > self.currentTime:
+            return self.queue.addEvent(event)
+
+        oldestTime = self.history.getOldestTickTime()
+        if oldestTime is None or eventTime <= oldestTime:
+            print 'Warning: event missed.'
+            self.missedCount += 1
+            return False
+
+        self._resimulate(event)
+        return True
+
+    def _executeTick(self, tickTime, events):
+        """
+        Executes 'events' as the tick starting at 'tickTime'.
+        """
+        self.history.beginTick(tickTime)
+        handler = self.handler
+        for event in events:
+            handler(event)
+
+        self._executed.append((tickTime, events))
+        if len(self._executed) > self.history.maxTicks:
+            self._executed.popleft()
+
+    def tick(self):
+        """
+        Simulates the next tick.  Returns the number of events executed.
+        """
+        tickTime = self.currentTime
+        self.tickCount += 1
+        self.currentTime = self._getTickTime(self.tickCount)
+        events = self.queue.getNextEvents(self.currentTime)
+        self._executeTick(tickTime, events)
+        return len(events)
+
+    def _getTickTime(self, tickIndex):
+        """
+        Returns the start of the tick numbered 'tickIndex'.
+        """
+        return self.startTime + tickIndex*self.timestep
+
+    def _resimulate(self, lateEvent):
+        """
+        Rolls back to the tick 'lateEvent' belongs to and simulates every
+        tick since then again, including the late event.
+        """
+        eventTime = lateEvent.getTime()
+        tickTime = self.history.rollback(eventTime)
+        self.rollbackCount += 1
+
+        events = []
+        executed = self._executed
+        while executed and executed[-1][0] >= tickTime:
+            events.extend(executed.pop()[1])
+        events.append(lateEvent)
+
+        records = [(event.getTime(), event.sequence, event) for event in events]
+        records.sort()
+        times = [record[0] for record in records]
+
+        start = 0
+        firstTick = int(round((tickTime - self.startTime)/self.timestep))
+        for tickIndex in xrange(firstTick, self.tickCount):
+            tickTime = self._getTickTime(tickIndex)
+            end = bisect.bisect_right(times, self._getTickTime(tickIndex + 1))
+            self._executeTick(tickTime, [record[2] for record in records[start:end]])
+            start = end
@@ -8,7 +8,11 @@
 #Sideline: Because of how cPython is implemented, only processes truly run simultaneously (but this doesn't matter for I/O access (according to the docs, that type of activity is still improved with threads))
 
 import time
-import Queue
+import itertools
+from heapq import heappush, heappop, heapify
+
+import Timing
+import Instrumentation
 
 try:
     import threading
@@ -29,14 +33,146 @@ class Server:
         receiver = Receiver()
         simulator = Simulator(receiver)
 
+# what a full MessageChannel does with a new message
+BLOCK = 'block'             # wait until the simulator makes room
+DROP_OLDEST = 'dropOldest'  # throw away the earliest message
+COALESCE = 'coalesce'       # always replace the client's pending message,
+                            # full or not, and drop the oldest if the
+                            # channel is full and the client has none
+
+class MessageChannel:
+    """
+    A bounded channel which hands messages from the Receiver to the
+    Simulator in time order.  Each message carries the time it is for
+    and the ID of the client which sent it.  put and drain take the lock
+    once per batch, and a full channel applies its overflow policy, so
+    memory stays bounded however fast clients send.  With COALESCE, a
+    client has at most one message waiting at any time, so the simulator
+    only sees the latest message of a client which floods the channel.
+    
+    queuedCount, droppedCount and coalescedCount count the messages
+    accepted, thrown away and replaced.
+    """
+    
+    def __init__(self, maxsize=1024, overflow=BLOCK):
+        if overflow not in (BLOCK, DROP_OLDEST, COALESCE):
+            raise ValueError("Unknown overflow policy %r" % (overflow,))
+        
+        self.maxsize = maxsize
+        self.overflow = overflow
+        
+        # heap of [time, sequence, clientID, message] entries; entries
+        # replaced by coalescing are cleared to the client ID _REPLACED
+        self._heap = []
+        self._size = 0
+        self._sequence = itertools.count()
+        # the pending entry of every client, for coalescing
+        self._pendingByClient = {}
+        
+        self._lock = threading.Lock()
+        self._notFull = threading.Condition(self._lock)
+        
+        self.queuedCount = 0
+        self.droppedCount = 0
+        self.coalescedCount = 0
+    
+    def put(self, message, messageTime=None, clientID=None):
+        """
+        Adds a message for 'messageTime' (by default, now) from the client
+        with 'clientID'.
+        """
+        if messageTime is None: messageTime = Timing.mostAccurateTime()
+        self.putMany([(messageTime, clientID, message)])
+    
+    def putMany(self, messages):
+        """
+        Adds every (messageTime, clientID, message) tuple in 'messages'.
+        """
+        self._lock.acquire()
+        try:
+            coalesce = self.overflow == COALESCE
+            for messageTime, clientID, message in messages:
+                if coalesce and clientID in self._pendingByClient:
+                    self._remove(self._pendingByClient[clientID])
+                    self.coalescedCount += 1
+                elif self._size >= self.maxsize:
+                    if self.overflow == BLOCK:
+                        while self._size >= self.maxsize:
+                            self._notFull.wait()
+                    else:
+                        self._dropOldest()
+                
+                entry = [messageTime, next(self._sequence), clientID, message]
+                heappush(self._heap, entry)
+                self._size += 1
+                self.queuedCount += 1
+                if clientID is not None:
+                    self._pendingByClient[clientID] = entry
+        finally:
+            self._lock.release()
+    
+    def _remove(self, entry):
+        """
+        Takes the pending 'entry' off the channel without touching the heap.
+        """
+        if entry[2] is not None:
+            del self._pendingByClient[entry[2]]
+        entry[2] = _REPLACED
+        self._size -= 1
+        if len(self._heap) > 2*self.maxsize:
+            self._heap = [e for e in self._heap if e[2] is not _REPLACED]
+            heapify(self._heap)
+    
+    def _pop(self):
+        """
+        Returns the earliest pending entry, removing it from the channel.
+        """
+        heap = self._heap
+        entry = heappop(heap)
+        while entry[2] is _REPLACED:
+            entry = heappop(heap)
+        if entry[2] is not None and self._pendingByClient.get(entry[2]) is entry:
+            del self._pendingByClient[entry[2]]
+        self._size -= 1
+        return entry
+    
+    def _dropOldest(self):
+        
+        self._pop()
+        self.droppedCount += 1
+    
+    def drain(self, maxCount=None):
+        """
+        Removes and returns the waiting messages, up to maxCount of them,
+        earliest first.
+        """
+        self._lock.acquire()
+        try:
+            count = self._size
+            if maxCount is not None and maxCount < count:
+                count = maxCount
+            messages = [self._pop()[3] for i in xrange(count)]
+            if count:
+                self._notFull.notifyAll()
+            return messages
+        finally:
+            self._lock.release()
+    
+    def qsize(self):
+        """
+        Returns the number of messages waiting.
+        """
+        return self._size
+
+_REPLACED = object()
+
 class Receiver:
-    def __init__(self):
-        self.simulatorQueue = Queue.Queue(maxsize=0) #No size limit; may want to use priority queues once events are actually sent (and sort by time)
+    def __init__(self, maxsize=1024, overflow=BLOCK):
+        self.simulatorQueue = MessageChannel(maxsize, overflow)
         self.proc = TrueThread(self.listen)
 
     def listen(self):
         while True:
-            print "Listening"
             time.sleep(1) #Pause in order to not freeze the program
             #Check if message was received from client
             self.receiveIfNecessary()
@@ -54,19 +190,126 @@ class Sender:
         self.proc = None
 
 class Simulator:
-    def __init__(self, receiver):
+    """
+    Advances the simulation in fixed steps of 'timestep' seconds.  Real
+    time is collected in an accumulator and as many steps are run as fit
+    in it, so the tick rate does not drift with load.  When the server
+    falls behind, at most 'maxStepsPerFrame' steps are run to catch up
+    before the rest of the backlog is dropped, so an overloaded server
+    runs slower than real time instead of falling further behind.
+    
+    Every step drains the whole message queue before calling update.
+    """
+    def __init__(self, receiver, timestep=0.05, maxStepsPerFrame=5):
         self.messageQueue = receiver.getMessageQueue()
+        self.timestep = timestep
+        self.maxStepsPerFrame = maxStepsPerFrame
+        
+        self.simulationTime = 0.0
+        self.running = True
+        
+        # tick statistics
+        self.tickCount = 0
+        self.lastTickStart = None
+        self.lastTickDuration = 0.0
+        self.maxTickDuration = 0.0
+        self.overrunCount = 0
+        self.droppedStepCount = 0
+        
         self.proc = TrueThread(self.simulate)
 
     def simulate(self):
-        while True:
-            print "Simulating"
-            time.sleep(0.1)
+        clock = Timing.mostAccurateTime
+        timestep = self.timestep
+        
+        accumulator = 0.0
+        previousTime = clock()
+        
+        while self.running:
+            currentTime = clock()
+            accumulator += currentTime - previousTime
+            previousTime = currentTime
+            
+            steps = 0
+            while accumulator >= timestep and steps < self.maxStepsPerFrame:
+                self.tick()
+                accumulator -= timestep
+                steps += 1
+            
+            if accumulator >= timestep:
+                # too far behind to catch up; skip the rest of the backlog
+                dropped = int(accumulator/timestep)
+                self.droppedStepCount += dropped
+                accumulator -= dropped*timestep
+            
+            # sleep until the next step is due; rounding can leave the
+            # accumulator a hair above the timestep
+            Timing.sleep(max(0.0, timestep - accumulator))
+
+    def tick(self):
+        """
+        Runs a single step: processes every waiting message, then
+        advances the simulation by one timestep.
+        """
+        tickStart = Timing.mostAccurateTime()
+        
+        for message in self.messageQueue.drain():
+            self.processMessage(message)
+        
+        self.update(self.simulationTime, self.timestep)
+        self.simulationTime += self.timestep
+        
+        duration = Timing.mostAccurateTime() - tickStart
+        self.reportTick(tickStart, duration, max(duration - self.timestep, 0.0))
+
+    def processMessage(self, message):
+        """
+        Called for every message received.  Subclasses override this.
+        """
+        pass
+
+    def update(self, simulationTime, timestep):
+        """
+        Advances the simulation from simulationTime by timestep seconds.
+        Subclasses override this.
+        """
+        pass
+
+    def reportTick(self, tickStart, duration, overrun):
+        """
+        Called after every step with the time it started, how long it
+        took and by how much it overran the timestep.  Subclasses may
+        override this to log or export the values.
+        """
+        self.tickCount += 1
+        self.lastTickStart = tickStart
+        self.lastTickDuration = duration
+        if duration > self.maxTickDuration:
+            self.maxTickDuration = duration
+        if overrun:
+            self.overrunCount += 1
+        
+        if Instrumentation.enabled:
+            Instrumentation.histogram('simulator.tickDuration').observe(duration)
+            if overrun:
+                Instrumentation.counter('simulator.overruns').add()
+            Instrumentation.gauge('simulator.messageQueueDepth').set(self.messageQueue.qsize())
 
-            try:
-                print self.messageQueue.get(False) #Do not block
-            except:
-                print "Message Queue is empty"
+    def stop(self):
+        """
+        Stops the simulation loop after the current frame.
+        """
+        self.running = False
 
 if __name__ == '__main__':
+    
+    # a coalescing channel keeps only the latest message of each client,
+    # even while it has room for more
+    channel = MessageChannel(maxsize=8, overflow=COALESCE)
+    channel.putMany([(1.0, 'a', 'a1'), (2.0, 'b', 'b1'), (3.0, 'a', 'a2'),
+                     (4.0, 'a', 'a3'), (5.0, None, 'anonymous')])
+    assert channel.qsize() == 3 and channel.coalescedCount == 2
+    assert channel.drain() == ['b1', 'a3', 'anonymous']
+    print 'Coalescing below capacity: ok'
+    
     aServer = Server()
\ No newline at end of file
@@ -1,10 +1,114 @@
-import os, time
+import os, sys, time
 
-# Define the mostAccurateTime function
-if os.name == 'nt':
-    mostAccurateTime = time.clock #time in seconds since program started (more accurate on Windows)
+# Define the monotonic time source, which never jumps when the wall clock
+# is adjusted
+if hasattr(time, 'monotonic'):
+    _monotonicTime = time.monotonic
+elif os.name == 'nt':
+    _monotonicTime = time.clock #time in seconds since program started (more accurate on Windows)
+elif sys.platform.startswith('linux'):
+    import ctypes, ctypes.util
+
+    class _TimeSpec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _CLOCK_MONOTONIC = 1
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                         ctypes.util.find_library('c'), use_errno=True)
+    _clockGetTime = _librt.clock_gettime
+    _clockGetTime.argtypes = [ctypes.c_int, ctypes.POINTER(_TimeSpec)]
+
+    def _monotonicTime():
+        timeSpec = _TimeSpec()
+        if _clockGetTime(_CLOCK_MONOTONIC, ctypes.byref(timeSpec)):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return timeSpec.tv_sec + timeSpec.tv_nsec * 1e-9
 else:
-    mostAccurateTime = time.time #time in seconds since epoch (more accurate on *nix)
+    _monotonicTime = time.time #time in seconds since epoch (more accurate on *nix)
+
+class SystemClock:
+    """
+    The wall clock.  Jumps whenever the system time is adjusted.
+    """
+
+    isVirtual = False
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class MonotonicClock:
+    """
+    A high resolution clock which never jumps.  It starts at the wall
+    clock time at which it was created, so its times can be compared
+    with times from other machines, and then only moves forward.
+    """
+
+    isVirtual = False
+
+    def __init__(self):
+
+        self._offset = time.time() - _monotonicTime()
+
+    def now(self):
+        return _monotonicTime() + self._offset
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class VirtualClock:
+    """
+    A clock which only moves when it is told to, so that simulations can
+    run faster than real time.  Sleeping on a virtual clock advances it
+    instead of waiting.
+    """
+
+    isVirtual = True
+
+    def __init__(self, startTime=0.0):
+
+        self.time = startTime
+
+    def now(self):
+        return self.time
+
+    def advance(self, seconds):
+        """Moves the clock forward by 'seconds'."""
+        self.time += seconds
+
+    def advanceTo(self, newTime):
+        """Moves the clock forward to 'newTime', if it is later."""
+        if newTime > self.time:
+            self.time = newTime
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+_clock = MonotonicClock()
+
+def setClock(clock):
+    """
+    Makes 'clock' the source of mostAccurateTime for the whole program,
+    and returns the previous clock.
+    """
+    global _clock
+    previousClock, _clock = _clock, clock
+    return previousClock
+
+def getClock():
+    """Returns the current clock."""
+    return _clock
+
+def mostAccurateTime():
+    """Returns the current time of the current clock, in seconds."""
+    return _clock.now()
+
+def sleep(seconds):
+    """Sleeps for 'seconds' on the current clock."""
+    _clock.sleep(seconds)
 
 class BasicTimer:
     """
@@ -91,7 +195,7 @@ class StopWatch:
     def start(self):
         """Start the stop watch.  Returns the start time."""
         
-        running, self.startTime = True, mostAccurateTime()
+        self.running, self.startTime = True, mostAccurateTime()
         return self.startTime
         
     def stop(self):
@@ -100,8 +204,8 @@ class StopWatch:
         stop watch was started.
         """
         
-        if running:
-            dt, running = mostAccurateTime - self.startTime, False
+        if self.running:
+            dt, self.running = mostAccurateTime() - self.startTime, False
         else:
             dt = 0
         return dt
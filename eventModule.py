@@ -26,36 +26,18 @@ event
 
 """
 
-import time
-import os
+import itertools
+from heapq import heappush, heappop
 
-def getAccTime():
-    if os.name == 'nt':
-        return time.clock()
-    else:
-        return time.time()
-
-class Manager:
-
-	def __init__(self):
-		#Create the event Queue, or register with it, as the case may be
-		pass
-
-	def addEvent(self, event):
-		#Add event to the queue
-		pass
+import Timing
+from Event import EventRecord, Manager, Executor, WaitableQueue
 
-	def tick(self):
-		#Called as often as possible, at the system management level
+# numbers events in the order they are created, so that events with equal
+# times can be ordered first come, first served
+_eventSequence = itertools.count()
 
-		#Loop through the top events in the queue, such that we have the next n
-		#events until a certain timestamp, where n is <= the max thread/proc
-		#count allocated for the event module
-
-		#For each of these n events, assign the event to an executor that exists
-		#or make a new one (this way, multiple events can be executed at once)
-
-		pass
+def getAccTime():
+    return Timing.mostAccurateTime()
 
 class AbstractQueue:
 	def __init__(self):
@@ -109,26 +91,21 @@ class AbstractQueue:
 		"""
 		pass
 
-class Executor: #inherits from a thread/process class like Allen Downey's, but
-				# with more intelligence about its own existence.
-	# It should be some kind of daemon that does not interrupt
-	# standard execution flow
-
-	#Executors must die if they have no event for a certain amount of time
-	def __init__(self):
-		pass
-
 class EventQueue:
 	def __init__(self, startTime = None):
 		"""
 		Sets up the event queue, which is a dictionary using keys
 		of the form int(time.time).  The keys point to SortCacheLists,
-		which store the events.
+		which store the EventRecords of the events.
 		"""
 
 		self.queuedEvents = {}
+		# a heap of the keys of queuedEvents, which may still hold keys
+		# whose lists have been deleted
+		self._timeIndices = []
+		self._sequence = itertools.count()
 
-		if startTime is None: startTime = time.time()
+		if startTime is None: startTime = Timing.mostAccurateTime()
 		self.lastTime = startTime
 
 	def addEvent(self,event):
@@ -137,7 +114,13 @@ class EventQueue:
 		"""
 		eventTime = event.getTime()
 		if eventTime > self.lastTime:
-			self.queuedEvents.setdefault( int(eventTime), SortCacheList() ).append(event)
+			record = EventRecord((eventTime, next(self._sequence), event))
+			timeIndex = int(eventTime)
+			records = self.queuedEvents.get(timeIndex)
+			if records is None:
+				records = self.queuedEvents[timeIndex] = SortCacheList()
+				heappush(self._timeIndices, timeIndex)
+			records.append(record)
 			return True
 		else:
 			print 'Warning: event missed.'
@@ -148,7 +131,7 @@ class EventQueue:
 		Returns the events which have yet to be executed and occur before
 		currentTime.
 		"""
-		if currentTime is None: currentTime = time.time()
+		if currentTime is None: currentTime = Timing.mostAccurateTime()
 
 		eventList = []
 		currentTimeIndex = int(currentTime)
@@ -161,8 +144,8 @@ class EventQueue:
 
 				timeIndexEvents.sort()
 
-				for event in timeIndexEvents:
-					eventList.append(event)
+				for record in timeIndexEvents:
+					eventList.append(record[2])
 
 				del self.queuedEvents[timeIndex]
 
@@ -174,23 +157,43 @@ class EventQueue:
 
 			for i in xrange(len(currentEvents)):
 
-				event = currentEvents[0]
-				if event.time <= currentTime:
-					eventList.append(currentEvents.pop(0))
+				record = currentEvents[0]
+				if record[0] <= currentTime:
+					eventList.append(currentEvents.pop(0)[2])
 				else:
 					break
 
+		# forget the keys of the seconds deleted above
+		timeIndices = self._timeIndices
+		while timeIndices and timeIndices[0] < currentTimeIndex:
+			heappop(timeIndices)
+
 		self.lastTime = currentTime
 
 		return eventList
 
+	def getNextEvent(self):
+		"""
+		Returns the newest event, leaving it on the queue (if an event exists)
+		"""
+		timeIndices = self._timeIndices
+		while timeIndices:
+			records = self.queuedEvents.get(timeIndices[0])
+			if records:
+				records.sort()
+				return records[0][2]
+			if records is not None:
+				del self.queuedEvents[timeIndices[0]]
+			heappop(timeIndices)
+		return None
+
 	def getEventCount(self):
 		"""
 		Returns the amount of events on the queue
 		"""
 		# (Dev Note: remember, direct object access by
 		# an external system is BAD for extensibility and modular design)
-		return reduce(lambda x,y: x+y, [len(t) for t in self.queuedEvents.itervalues()])
+		return sum(len(t) for t in self.queuedEvents.itervalues())
 
 class SortedList(list):
 
@@ -234,35 +237,43 @@ class SortCacheList(list):
 		self.isSorted = False
 		super(SortCacheList, self).append(item)
 
-class TestEvent:
+class TestEvent(object):
+
+	__slots__ = ('time', 'sequence', 'data')
 
-	def __init__(self, data=None):
+	def __init__(self, data=None, delay=0):
 
-		self.time = time.time()
+		self.time = Timing.mostAccurateTime() + delay
+		self.sequence = next(_eventSequence)
 		self.data = data
 
 	def getTime(self):
 
 		return self.time
 
+	def execute(self):
+
+		pass
+
 	def __cmp__(self, other):
 
-		return self.time > other.time
+		return cmp((self.time, self.sequence), (other.time, other.sequence))
 
 if __name__ == '__main__':
 
 	import random
 
-	startTime = currentTime = time.time()
+	startTime = currentTime = Timing.mostAccurateTime()
 	delay = 5.246
-	eq=EventQueue(startTime-delay)
+	eq=WaitableQueue(EventQueue(startTime))
 
 	# add 500 events to the queue to execute after "delay" seconds.
 	for t in xrange(500):
-		eq.addEvent(TestEvent())
+		eq.addEvent(TestEvent(delay=delay))
 
+	# sleep until the events are due instead of polling for them
 	numEvents = 0
 	while numEvents < 500:
-		currentTime = time.time()
-		numEvents+=len(eq.getNextEvents(currentTime-delay))
+		numEvents+=len(eq.waitForNextEvents())
+		currentTime = Timing.mostAccurateTime()
 	print 'Elapsed time: %.3f'%(currentTime-startTime)